@@ -0,0 +1,127 @@
+from django.conf import settings
+
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'PWBLOOM1'
+HEADER = struct.Struct('<8sQII') # magic, bits, hashes, keys
+
+CHECK_INTERVAL = 5 # seconds between checks for a new generation of the filter
+
+class BloomFilter(object):
+    """
+    Probabilistic set of (release, architecture, package) that can say for certain a binary package has never appeared
+    in an advisory, so matching can skip it without asking anything else.
+    """
+
+    def __init__(self, bits, hashes, data=None, keys=0):
+        self.bits = bits
+        self.hashes = hashes
+        self.keys = keys
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, keys, false_positive_rate):
+        keys = max(keys, 1)
+        bits = max(int(math.ceil(-keys * math.log(false_positive_rate) / math.log(2) ** 2)), 64)
+        return cls(bits, max(int(round(bits / keys * math.log(2))), 1))
+
+    def _positions(self, release, architecture, package):
+        digest = hashlib.blake2b(('%s\0%s\0%s' % (release, architecture, package)).encode('utf-8'), digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for i in range(self.hashes):
+            yield (first + i * second) % self.bits
+
+    def add(self, release, architecture, package):
+        for position in self._positions(release, architecture, package):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.keys += 1
+
+    def might_contain(self, release, architecture, package):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(release, architecture, package))
+
+    def false_positive_rate(self):
+        """
+        Estimated chance that a package which was never in an advisory is reported as possibly present.
+        """
+
+        filled = sum(bin(byte).count('1') for byte in self.data) / self.bits
+        return filled ** self.hashes
+
+    def save(self, path):
+        incoming = '%s.incoming' % path
+        with open(incoming, 'wb') as filter_file:
+            filter_file.write(HEADER.pack(MAGIC, self.bits, self.hashes, self.keys))
+            filter_file.write(self.data)
+        os.replace(incoming, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as filter_file:
+            magic, bits, hashes, keys = HEADER.unpack(filter_file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not an advisory package filter" % path)
+            return cls(bits, hashes, filter_file.read(), keys)
+
+def build(path, keys):
+    """
+    Write a filter of every (release, architecture, package) in keys to path, sized for ADVISORY_FILTER_FALSE_POSITIVE_RATE.
+    """
+
+    keys = set(keys)
+    bloom = BloomFilter.for_capacity(len(keys), getattr(settings, 'ADVISORY_FILTER_FALSE_POSITIVE_RATE', 0.01))
+    for release, architecture, package in keys:
+        bloom.add(release, architecture, package)
+    bloom.save(path)
+    return bloom
+
+def filter_path():
+    return getattr(settings, 'ADVISORY_FILTER', '%s/advisory_cache/match.bloom' % settings.BASE_DIR)
+
+_lock = threading.Lock()
+_filter = None
+_filter_mtime = None
+_checked = 0
+
+def get_filter():
+    """
+    The current generation of the filter, or None if there isn't one and every package has to be matched.
+    """
+
+    global _filter, _filter_mtime, _checked
+    with _lock:
+        if time.time() - _checked < CHECK_INTERVAL:
+            return _filter
+        _checked = time.time()
+
+        try:
+            mtime = os.stat(filter_path()).st_mtime_ns
+        except OSError:
+            _filter = None
+            return None
+
+        if _filter is None or mtime != _filter_mtime:
+            try:
+                _filter = BloomFilter.load(filter_path())
+                _filter_mtime = mtime
+            except (OSError, ValueError, struct.error):
+                _filter = None
+        return _filter
+
+def discard():
+    """
+    Remove the filter, e.g. when advisory packages it doesn't know about are added, so nothing is ruled out until the
+    next rebuild.
+    """
+
+    global _filter
+    with _lock:
+        _filter = None
+        try:
+            os.remove(filter_path())
+        except OSError:
+            pass
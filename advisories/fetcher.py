@@ -0,0 +1,170 @@
+from django.conf import settings
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+class Fetcher(object):
+    """
+    HTTP client for the advisory feeds that remembers the ETag and Last-Modified validators of each URL, so sources that
+    haven't changed upstream aren't downloaded again.
+
+    It is safe to share between threads. Requests go through one pooled session that retries with backoff, and no more
+    than ADVISORY_FETCH_PER_HOST are made to the same host at once.
+    """
+
+    def __init__(self, cache_location=None):
+        self.cache_location = cache_location or '%s/advisory_cache/http' % settings.BASE_DIR
+        self.workers = getattr(settings, 'ADVISORY_FETCH_WORKERS', 8)
+        self.per_host = getattr(settings, 'ADVISORY_FETCH_PER_HOST', 4)
+        retry = Retry(total=getattr(settings, 'ADVISORY_FETCH_RETRIES', 5), backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_location)
+        except OSError: # directory already exists
+            pass
+
+    def _path(self, url, suffix):
+        return '%s/%s.%s' % (self.cache_location, hashlib.sha256(url.encode('utf-8')).hexdigest(), suffix)
+
+    def _write(self, path, data):
+        incoming = '%s.incoming' % path
+        with open(incoming, 'wb') as incoming_file:
+            incoming_file.write(data)
+        os.replace(incoming, path)
+
+    def validators(self, url):
+        """
+        Validators stored for a URL, as a dictionary of request headers.
+        """
+
+        try:
+            with open(self._path(url, 'json')) as validators_file:
+                stored = json.load(validators_file)
+        except (OSError, ValueError):
+            return {}
+
+        headers = {}
+        if stored.get('etag'):
+            headers['If-None-Match'] = stored['etag']
+        if stored.get('last_modified'):
+            headers['If-Modified-Since'] = stored['last_modified']
+        return headers
+
+    def remember(self, url, response):
+        """
+        Store the validators of a response to a URL, to be sent with the next request for it. Callers that process a
+        response as they go should only do this once they have finished, so a failed run is retried next time.
+        """
+
+        stored = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        self._write(self._path(url, 'json'), json.dumps(stored).encode('utf-8'))
+
+    def forget(self, url):
+        for suffix in ('json', 'body', 'missing'):
+            try:
+                os.remove(self._path(url, suffix))
+            except OSError:
+                pass
+
+    def _host_limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.hosts_lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def request(self, url, **kwargs):
+        """
+        GET a URL unconditionally, whatever the response.
+        """
+
+        with self._host_limit(url):
+            response = self.session.get(url, **kwargs)
+            if not kwargs.get('stream'):
+                response.content # read the body while holding the host's slot
+            return response
+
+    def get(self, url, **kwargs):
+        """
+        Conditionally GET a URL, returning None if it hasn't changed since the validators were last remembered.
+        """
+
+        headers = dict(kwargs.pop('headers', {}))
+        headers.update(self.validators(url))
+        response = self.request(url, headers=headers, **kwargs)
+        if response.status_code == 304:
+            response.close()
+            return None
+        response.raise_for_status()
+        return response
+
+    def fetch(self, url):
+        """
+        Content of a URL along with whether it changed since the last fetch. The last content is kept on disk, so an
+        unchanged URL costs a conditional request and no download.
+        """
+
+        try:
+            with open(self._path(url, 'body'), 'rb') as body_file:
+                body = body_file.read()
+        except OSError: # nothing kept, so a conditional request can't be answered
+            body = None
+            self.forget(url)
+
+        response = self.get(url)
+        if response is None:
+            return body, False
+
+        self._write(self._path(url, 'body'), response.content)
+        self.remember(url, response)
+        return response.content, True
+
+    def fetch_immutable(self, url, missing_for=0):
+        """
+        Content of a URL whose content never changes once it exists, or None if it doesn't exist (yet).
+
+        Content is kept for good, so the URL is only ever downloaded once, and a 404 is remembered for missing_for
+        seconds before the URL is asked for again.
+        """
+
+        try:
+            with open(self._path(url, 'body'), 'rb') as body_file:
+                return body_file.read()
+        except OSError:
+            pass
+
+        try:
+            if time.time() - os.stat(self._path(url, 'missing')).st_mtime < missing_for:
+                return None
+        except OSError:
+            pass
+
+        response = self.request(url)
+        if response.status_code == 404:
+            self._write(self._path(url, 'missing'), b'')
+            return None
+        response.raise_for_status()
+
+        self._write(self._path(url, 'body'), response.content)
+        try:
+            os.remove(self._path(url, 'missing'))
+        except OSError:
+            pass
+        return response.content
@@ -0,0 +1,75 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from advisories.models import Advisory, BinaryPackage, Problem, expected_problems, reconcile_problems
+from api.models import Host, Package
+from api.versions import version_compare_stats
+
+def match_shard(shard):
+    """
+    Run in a worker process: the problems that should be open for one (release, architecture).
+    """
+
+    release, architecture, host_ids, advisory_ids = shard
+    started = time.time()
+    before = version_compare_stats() # the worker may have matched other shards already
+    try:
+        expected, considered = expected_problems(release, architecture, host_ids, advisory_ids)
+    finally:
+        connections.close_all()
+    after = version_compare_stats()
+    hits, lookups = after['hits'] - before['hits'], after['hits'] + after['misses'] - before['hits'] - before['misses']
+    return release, architecture, expected, considered, time.time() - started, hits / lookups if lookups else 0.0
+
+class Command(BaseCommand):
+    help = 'Rebuild the set of open problems from installed packages and advisory packages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', action='append', dest='hosts', help='Only re-match this host (identifier or node key), may be given more than once')
+        parser.add_argument('--advisory', action='append', dest='advisories', help='Only re-match this advisory (upstream ID), may be given more than once')
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes')
+
+    def handle(self, *args, **options):
+        host_ids = None
+        if options['hosts']:
+            host_ids = set(Host.objects.filter(identifier__in=options['hosts']).values_list('id', flat=True)) | set(Host.objects.filter(node_key__in=options['hosts']).values_list('id', flat=True))
+            if not host_ids:
+                raise CommandError("no hosts match %s" % ", ".join(options['hosts']))
+
+        advisory_ids = None
+        if options['advisories']:
+            advisory_ids = set(Advisory.objects.filter(upstream_id__in=options['advisories']).values_list('id', flat=True))
+            if not advisory_ids:
+                raise CommandError("no advisories match %s" % ", ".join(options['advisories']))
+
+        packages = Package.objects.all()
+        if host_ids is not None:
+            packages = packages.filter(host_id__in=host_ids)
+        releases = set(BinaryPackage.objects.values_list('release', flat=True).distinct())
+        shards = [(release, architecture, host_ids, advisory_ids) for release, architecture in packages.values_list('release', 'architecture').distinct() if release in releases]
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Re-matching %i release/architecture shards with %i processes..." % (len(shards), options['processes'])))
+        connections.close_all() # connections must not be shared with the worker processes
+        started = time.time()
+        snapshot = timezone.now() # problems ingest opens or closes from here on are newer than what the workers see
+        expected = set()
+        considered = 0
+        with multiprocessing.Pool(options['processes']) as pool:
+            for done, (release, architecture, shard_expected, shard_considered, elapsed, hit_rate) in enumerate(pool.imap_unordered(match_shard, shards), 1):
+                expected |= shard_expected
+                considered += shard_considered
+                self.stdout.write("  [%i/%i] %s/%s: %i packages in %.1fs, %i problems, %.0f%% version comparisons cached (%.0f rows/sec overall)" % (done, len(shards), release, architecture, shard_considered, elapsed, len(shard_expected), hit_rate * 100, considered / max(time.time() - started, 0.001)))
+
+        open_problems = Problem.objects.all()
+        if host_ids is not None:
+            open_problems = open_problems.filter(host_id__in=host_ids)
+        if advisory_ids is not None:
+            open_problems = open_problems.filter(advisory_id__in=advisory_ids)
+
+        with transaction.atomic():
+            created, closed = reconcile_problems(expected, open_problems, since=snapshot)
+        self.stdout.write("%i packages considered in %.1fs, %i problems opened, %i problems closed" % (considered, time.time() - started, created, closed))
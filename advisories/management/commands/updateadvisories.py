@@ -1,6 +1,8 @@
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import bz2
+import hashlib
 import lzma
 import json
 import os
@@ -19,11 +21,14 @@ import apt_inst
 import apt
 
 import pytz
-import requests
 import svn.remote
 
 
-from advisories.models import Advisory, SourcePackage, BinaryPackage, Vulnerability
+from api.jsonstream import JSONStream
+
+from advisories import packagemap
+from advisories.fetcher import Fetcher
+from advisories.models import Advisory, SourcePackage, BinaryPackage, Vulnerability, build_match_index, build_package_filter
 
 import logging
 
@@ -38,7 +43,7 @@ class DebianFeed(object):
     Syncs additions to the official DSA list in to the local database, as well as retrieving and parsing metadata about each one.
     """
 
-    def __init__(self, secure_testing_url=None, cache_location=None, releases=None, architectures=None, snapshot_url=None, security_apt_url=None, list_location=None):
+    def __init__(self, secure_testing_url=None, cache_location=None, releases=None, architectures=None, snapshot_url=None, security_apt_url=None, list_location=None, fetcher=None):
         self.secure_testing_url = secure_testing_url or "svn://anonscm.debian.org/svn/secure-testing"
         self.client = svn.remote.RemoteClient(self.secure_testing_url)
         self.cache_location = cache_location or "%s/advisory_cache/dsa" % settings.BASE_DIR
@@ -55,6 +60,7 @@ class DebianFeed(object):
         self.snapshot_url = snapshot_url or "http://snapshot.debian.org"
         self.security_apt_url = security_apt_url or "http://security.debian.org/debian-security"
         self.list_location = list_location or "data/DSA/list"
+        self.fetcher = fetcher or Fetcher()
 
     def _update_svn_repository(self):
         """
@@ -138,75 +144,135 @@ class DebianFeed(object):
                     
         return advisories
 
-    def update_local_database(self):
+    def _update_dsa_descriptions(self):
         """
-        Update the local repository, parse it and add any new advisories to the local database.
+        Long descriptions of each DSA from the RDF feed, keyed by lower case DSA name.
         """
 
         print("  Updating DSA RDF feed... ", end='')
         try:
-            dsa_rdf_soup = BeautifulSoup(requests.get('https://www.debian.org/security/dsa-long').content, 'html.parser')
+            dsa_rdf, changed = self.fetcher.fetch('https://www.debian.org/security/dsa-long')
+            dsa_rdf_soup = BeautifulSoup(dsa_rdf, 'html.parser')
             dsa_descriptions = {i.attrs['rdf:about'].split('/')[-1].lower():BeautifulSoup(i.description.text, 'html.parser').get_text().strip() for i in dsa_rdf_soup.find_all('item')}
-            print("OK")
+            print("OK" if changed else "unchanged")
         except:
             print("could not update DSA RDF feed")
             dsa_descriptions = {}
+        return dsa_descriptions
+
+    def _update_repository_data(self):
+        """
+        Build a reverse mapping of (release, source package, source version) to {binary package: {architecture: version}}
+        from the security repository, for working out what binary packages a particular source package builds.
+        """
 
         print("  Updating security repository data... ", end='')
 
-        release_metadata = {}
         source_packages = {}
+        packages_maps = [] # (release, architecture, rows from packagemap.parse) for each Packages file
+        digests = set()
+
+        with ThreadPoolExecutor(self.fetcher.workers) as executor:
+            # grab the release metadata from the repository
+            release_urls = {release_name: "%s/dists/%s/updates/Release" % (self.security_apt_url, release_name) for release_name in self.releases}
+            release_metadata = {release_name: deb822.Release(release_data.decode('utf-8')) for release_name, (release_data, changed) in zip(release_urls, executor.map(self.fetcher.fetch, release_urls.values()))}
+
+            # grab the binary package metadata for the desired architectures, unless a Packages file with the same
+            # checksum has been parsed before, parsing each file here as it arrives
+            packages_downloads = {}
+            for release_name, release_metadatum in release_metadata.items():
+                release_base = release_urls[release_name].rsplit('/', 1)[0] + '/'
+                checksums = {checksum['name']: checksum['sha256'] for checksum in release_metadatum.get('SHA256', [])}
+
+                # Chooses which filetype to use
+                if 'Packages.xz\n' in str(release_metadatum):
+                    package_filetype = 'xz'
+                elif 'Packages.bz2\n' in str(release_metadatum):
+                    package_filetype = 'bz2'
+                else:
+                    raise Exception("Unknown package type")
+
+                for component in release_metadatum['Components'].split():
+                    for architecture in [architecture for architecture in release_metadatum['Architectures'].split() if architecture in self.architectures]:
+                        packages_url = "%s/dists/%s/%s/binary-%s/Packages.%s" % (self.security_apt_url, release_name, component, architecture, package_filetype)
+                        digest = checksums.get(packages_url[len(release_base):]) if packages_url.startswith(release_base) else None
+                        rows = packagemap.load(digest) if digest else None
+                        if rows is None:
+                            packages_downloads[executor.submit(self.fetcher.request, packages_url)] = (release_name, architecture, package_filetype, digest)
+                        else:
+                            packages_maps.append((release_name, architecture, rows))
+                        digests.add(digest)
+
+            for download in as_completed(packages_downloads):
+                release_name, architecture, package_filetype, digest = packages_downloads[download]
+
+                # Decompresses the package data
+                response = download.result()
+                response.raise_for_status()
+                if package_filetype == 'xz':
+                    packages = deb822.Deb822.iter_paragraphs(lzma.decompress(response.content).decode("utf-8"))
+                elif package_filetype == 'bz2':
+                    packages = deb822.Deb822.iter_paragraphs(bz2.decompress(response.content).decode("utf-8"))
+                else:
+                    raise Exception('Unable to extract file')
+
+                rows = packagemap.parse(packages)
+                if digest is not None and hashlib.sha256(response.content).hexdigest() == digest: # not caught mid-update
+                    packagemap.save(digest, rows)
+                packages_maps.append((release_name, architecture, rows))
+
+        for release_name, architecture, rows in packages_maps:
+            for source_package_name, source_package_version, binary_package_name, binary_package_version in rows:
+                source_package_key = (release_name, source_package_name, source_package_version)
+
+                if source_package_key not in source_packages:
+                    source_packages[source_package_key] = {}
+
+                if binary_package_name not in source_packages[source_package_key]:
+                    source_packages[source_package_key][binary_package_name] = {}
+
+                source_packages[source_package_key][binary_package_name][architecture] = binary_package_version
+
+        packagemap.prune(digests)
+        print("OK, %i of %i package lists changed" % (len(packages_downloads), len(packages_maps)))
+        return source_packages
+
+    def _fetch_snapshot(self, package, version):
+        """
+        snapshots.d.o's list of the files built from a source package version, or None if it doesn't know of it.
 
-        # grab the release metadata from the repository
-        for release_name in self.releases:
-            release_metadata[release_name] = deb822.Release(requests.get("%s/dists/%s/updates/Release" % (self.security_apt_url, release_name)).text)
-
-
-        # grab the binary package metadata for the desired architectures
-        # this section attempts to make a reverse mapping for working out what binary packages a particular source package builds
-        for release_name, release_metadatum in release_metadata.items():
-
-            # Chooses which filetype to use
-            if 'Packages.xz\n' in str(release_metadatum):
-                package_filetype = 'xz'
-            elif 'Packages.bz2\n' in str(release_metadatum):
-                package_filetype = 'bz2'
-            else:
-                raise Exception("Unknown package type")
-
-            for component in release_metadatum['Components'].split():
-                for architecture in [architecture for architecture in release_metadatum['Architectures'].split() if architecture in self.architectures]:
-
-                    # Gets and decompresses the package data
-                    packages_url = "%s/dists/%s/%s/binary-%s/Packages.%s" % (self.security_apt_url, release_name, component, architecture, package_filetype)
-                    if package_filetype == 'xz':
-                        packages = deb822.Deb822.iter_paragraphs(lzma.decompress(requests.get(packages_url).content).decode("utf-8"))
-                    elif package_filetype == 'bz2':
-                        packages = deb822.Deb822.iter_paragraphs(bz2.decompress(requests.get(packages_url).content).decode("utf-8"))
-                    else:
-                        raise Exception('Unable to extract file')
-
-
-                    for binary_package in packages:
-                        source_field = binary_package.get('Source', binary_package['Package']).split()
-                        source_package_name = source_field[0]
+        These never change, so are only downloaded once, and versions it doesn't know of are only asked about again after
+        ADVISORY_SNAPSHOT_MISSING_TTL.
+        """
 
-                        try:
-                            source_package_version = source_field[1].strip('()')
-                        except IndexError:
-                            source_package_version = binary_package['Version']
+        snapshot_url = "%s/mr/package/%s/%s/allfiles" % (self.snapshot_url, package, version)
+        snapshot_data = self.fetcher.fetch_immutable(snapshot_url, getattr(settings, 'ADVISORY_SNAPSHOT_MISSING_TTL', 3 * 24 * 60 * 60))
+        if snapshot_data is None:
+            return None
+        try:
+            return json.loads(snapshot_data.decode('utf-8'))
+        except ValueError: # don't keep a broken response
+            self.fetcher.forget(snapshot_url)
+            raise
 
-                        source_package_key = (release_name, source_package_name, source_package_version)
+    def _prefetch_snapshots(self, lookups):
+        """
+        Start looking up each (source package, version) on snapshots.d.o in the background, returning a future for each.
+        """
 
-                        if source_package_key not in source_packages:
-                            source_packages[source_package_key] = {}
+        executor = ThreadPoolExecutor(self.fetcher.workers)
+        snapshots = {lookup: executor.submit(self._fetch_snapshot, *lookup) for lookup in lookups}
+        executor.shutdown(wait=False) # the lookups already queued carry on
+        return snapshots
 
-                        if binary_package['Package'] not in source_packages[source_package_key]:
-                            source_packages[source_package_key][binary_package['Package']] = {}
+    def update_local_database(self):
+        """
+        Update the local repository, parse it and add any new advisories to the local database.
 
-                        source_packages[source_package_key][binary_package['Package']][architecture] = binary_package['Version']
+        The RDF feed and the security repository are only consulted when there are new advisories to add, and only
+        downloaded again when they have changed upstream.
+        """
 
-        print("OK")
         print("  Updating security-tracker data... ", end='')
 
         self._update_svn_repository()
@@ -217,6 +283,14 @@ class DebianFeed(object):
         new_advisories = set(svn_advisories) - set([advisory.upstream_id for advisory in Advisory.objects.filter(source='debian')])
 
         print("  Found %i new DSAs/DLAs to download" % len(new_advisories))
+        if not new_advisories:
+            return
+
+        dsa_descriptions = self._update_dsa_descriptions()
+        source_packages = self._update_repository_data()
+
+        # source packages no longer current in the repo are looked up on snapshots.d.o while the advisories are added
+        snapshots = self._prefetch_snapshots({(package, version) for advisory in new_advisories for package, versions in svn_advisories[advisory]['packages'].items() for release, version in versions.items() if (release, package, version) not in source_packages})
 
         for advisory in new_advisories:
             print("    Downloading %s... " % advisory, end='')
@@ -255,12 +329,10 @@ class DebianFeed(object):
                                         search_packages.add(binary_package_name)
                                         search_packages.add(version)
                             else: # package is not latest in the repo, hopefully it's on snapshots.d.o
-                                snapshot_url = "%s/mr/package/%s/%s/allfiles" % (self.snapshot_url, package, version)
-                                snapshot_response = requests.get(snapshot_url)
-                                if snapshot_response.status_code == 404:
+                                snapshot_data = snapshots[(package, version)].result()
+                                if snapshot_data is None:
                                     print('Package not in snapshots either, removing for now and will try again next time')
                                     raise IntegrityError("No packages for this advisory yet")
-                                snapshot_data = snapshot_response.json()
                                 if snapshot_data['version'] != version:
                                     raise Exception("snapshots.d.o returned non-matching result")
 
@@ -286,7 +358,8 @@ class UbuntuFeed(object):
     Syncs the latest additions to the USN JSON file in to the local database.
     """
 
-    def __init__(self, usn_url=None, cache_location=None, releases=None, architectures=None):
+    def __init__(self, usn_url=None, cache_location=None, releases=None, architectures=None, fetcher=None):
+        self.fetcher = fetcher or Fetcher()
         self.usn_url = usn_url or 'https://usn.ubuntu.com/usn-db/database.json.bz2'
         self.cache_location = cache_location or '%s/advisory_cache/usn' % settings.BASE_DIR
         self.releases = releases or (
@@ -301,14 +374,17 @@ class UbuntuFeed(object):
 
     def _update_json_advisories(self):
         """
-        Download and decompress the latest USN data from Ubuntu.
+        Download the latest USN data from Ubuntu, returning the response if it has changed since the last update or None
+        if it hasn't.
         """
         try:
             os.makedirs(self.cache_location)
         except OSError: # directory already exists
             pass
 
-        response = requests.get(self.usn_url, stream=True) # the USN list is a bzip'd JSON file of all the current advisories for all supported releases
+        response = self.fetcher.get(self.usn_url, stream=True) # the USN list is a bzip'd JSON file of all the current advisories for all supported releases
+        if response is None:
+            return None
         bytes_downloaded = 0
         with open("%s/incoming-database.json.bz2" % self.cache_location, 'wb') as f:
             for chunk in response.iter_content(chunk_size=1024):
@@ -319,23 +395,30 @@ class UbuntuFeed(object):
 
         if bytes_downloaded < 1500: # sanity check
             raise Exception("could not download USN feed")
-        else:
-            try:
-                # un-bzip the file using the bz2 library and atomically replace the existing one if this succeeds
-                with open("%s/incoming-database.json" % self.cache_location, 'wb') as decompressed, bz2.BZ2File("%s/incoming-database.json.bz2" % self.cache_location, 'rb') as compressed:
-                    for data in iter(lambda : compressed.read(100 * 1024), b''):
-                        decompressed.write(data)
-                os.rename("%s/incoming-database.json" % self.cache_location, "%s/database.json" % self.cache_location)
-            except:
-                raise Exception("could not decompress USN feed")
 
-    def _parse_json_advisories(self):
+        # atomically replace the existing file, it's read compressed so the decompressed copy isn't needed any more
+        os.rename("%s/incoming-database.json.bz2" % self.cache_location, "%s/database.json.bz2" % self.cache_location)
+        try:
+            os.remove("%s/database.json" % self.cache_location)
+        except OSError:
+            pass
+        return response
+
+    def _parse_json_advisories(self, existing):
         """
-        Produce a dictionary representing USN data from the cache file.
+        Yield (USN, data) for each advisory in the cache file whose USN isn't in existing.
+
+        The file is parsed as it is decompressed, and existing advisories are passed over without being parsed, so only
+        the new advisories are ever held in memory.
         """
 
-        with open("%s/database.json" % self.cache_location) as usn_list_file:
-            return json.loads(usn_list_file.read())
+        with bz2.BZ2File("%s/database.json.bz2" % self.cache_location, 'rb') as usn_list_file:
+            stream = JSONStream(usn_list_file)
+            for advisory in stream.iter_object():
+                if advisory in existing:
+                    stream.skip_value()
+                else:
+                    yield advisory, stream.read_value()
 
     @transaction.atomic
     def update_local_database(self):
@@ -343,20 +426,21 @@ class UbuntuFeed(object):
         Retrieve the latest JSON data, parse it and add any new advisories to the local database.
         """
         print("  Downloading JSON data...")
-        self._update_json_advisories()
-        json_advisories = self._parse_json_advisories()
-        new_advisories = set(json_advisories) - set(['-'.join(advisory.upstream_id.split('-')[1:]) for advisory in Advisory.objects.filter(source='ubuntu')])
-
-        print("  Found %i new USNs to process" % len(new_advisories))
-
-
-        for advisory in new_advisories:
+        response = self._update_json_advisories()
+        if response is None:
+            print("  USN data unchanged since the last update")
+            return
+        transaction.on_commit(lambda: self.fetcher.remember(self.usn_url, response)) # only skip this data once it's in
+        existing_advisories = set(['-'.join(advisory.upstream_id.split('-')[1:]) for advisory in Advisory.objects.filter(source='ubuntu')])
+
+        new_advisories = 0
+        for advisory, advisory_data in self._parse_json_advisories(existing_advisories):
             print("    Processing USN %s... " % advisory, end='')
+            new_advisories += 1
 
             search_packages = set()
 
             try:
-                advisory_data = json_advisories[advisory]
                 db_advisory = Advisory(
                     upstream_id="USN-%s" % advisory,
                     source="ubuntu",
@@ -374,7 +458,7 @@ class UbuntuFeed(object):
                     db_vulnerability.advisories.add(db_advisory)
                     db_vulnerability.save()
                 
-                for release, release_data in {release:release_data for release, release_data in json_advisories[advisory]['releases'].items() if release in self.releases}.items():
+                for release, release_data in {release:release_data for release, release_data in advisory_data['releases'].items() if release in self.releases}.items():
 
                     # Source packages
                     for src_package, src_package_data in release_data['sources'].items():
@@ -407,22 +491,31 @@ class UbuntuFeed(object):
             else:
                 print("OK")
 
+        print("  Found %i new USNs" % new_advisories)
+
 class Command(BaseCommand):
     help = 'Update all sources of advisories'
 
     def handle(self, *args, **options):
+        fetcher = Fetcher()
+
         self.stdout.write(self.style.MIGRATE_HEADING("Updating DSAs..."))
-        feed = DebianFeed()
+        feed = DebianFeed(fetcher=fetcher)
         feed.update_local_database()
 
         self.stdout.write(self.style.MIGRATE_HEADING("Updating DLAs..."))
-        feed = DebianFeed(cache_location='%s/advisory_cache/dla' % settings.BASE_DIR, list_location='data/DLA/list')
+        feed = DebianFeed(cache_location='%s/advisory_cache/dla' % settings.BASE_DIR, list_location='data/DLA/list', fetcher=fetcher)
         feed.update_local_database()
 
         self.stdout.write(self.style.MIGRATE_HEADING("Updating USNs..."))
-        feed = UbuntuFeed()
+        feed = UbuntuFeed(fetcher=fetcher)
         feed.update_local_database()
 
 
+        self.stdout.write(self.style.MIGRATE_HEADING("Compiling advisory match index..."))
+        self.stdout.write("  %i binary packages indexed" % build_match_index())
+        package_filter = build_package_filter()
+        self.stdout.write("  %i binary packages filtered in %i bytes, estimated false positive rate %.4f" % (package_filter.keys, len(package_filter.data), package_filter.false_positive_rate()))
+
         with open("%s/advisory_cache/timestamp" % settings.BASE_DIR, 'w') as timestamp:
             timestamp.write(str(int(time.time())))
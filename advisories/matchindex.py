@@ -0,0 +1,141 @@
+from django.conf import settings
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'PWMATCH1'
+HEADER = struct.Struct('<8sI')
+ENTRY = struct.Struct('<IIII') # key offset, key length, value offset, value count
+VALUE = struct.Struct('<QQH') # binary package id, advisory id, safe version length, followed by the safe version
+
+CHECK_INTERVAL = 5 # seconds between checks for a new generation of the index
+
+def _key(release, architecture, package):
+    return ('%s\0%s\0%s' % (release, architecture, package)).encode('utf-8')
+
+def build(path, rows):
+    """
+    Write an index of (release, architecture, package, safe_version, advisory id, binary package id) rows to path.
+
+    The file is written alongside and renamed in to place, so processes with the old generation mapped keep using it
+    until they notice the new one.
+    """
+
+    entries = {}
+    for release, architecture, package, safe_version, advisory_id, binary_package_id in rows:
+        if safe_version is None: # nothing to compare against
+            continue
+        entries.setdefault(_key(release, architecture, package), []).append((binary_package_id, advisory_id, safe_version.encode('utf-8')))
+
+    keys = sorted(entries)
+    table = []
+    key_data = bytearray()
+    value_data = bytearray()
+    for key in keys:
+        table.append((len(key_data), len(key), len(value_data), len(entries[key])))
+        key_data += key
+        for binary_package_id, advisory_id, safe_version in entries[key]:
+            value_data += VALUE.pack(binary_package_id, advisory_id, len(safe_version)) + safe_version
+
+    keys_start = HEADER.size + ENTRY.size * len(keys)
+    values_start = keys_start + len(key_data)
+    incoming = '%s.incoming' % path
+    with open(incoming, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(keys)))
+        for key_offset, key_length, value_offset, value_count in table:
+            index_file.write(ENTRY.pack(keys_start + key_offset, key_length, values_start + value_offset, value_count))
+        index_file.write(key_data)
+        index_file.write(value_data)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(incoming, path)
+    return len(keys)
+
+class MatchIndex(object):
+    """
+    Read-only, memory-mapped view of an index written by build().
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.stat = os.fstat(index_file.fileno())
+            self.map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not an advisory match index" % path)
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self.map, HEADER.size + ENTRY.size * position)
+
+    def lookup(self, release, architecture, package):
+        """
+        (safe version, advisory id, binary package id) for every advisory naming this binary package.
+        """
+
+        key = _key(release, architecture, package)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_count = self._entry(middle)
+            candidate = self.map[key_offset:key_offset + key_length]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                matches = []
+                for _ in range(value_count):
+                    binary_package_id, advisory_id, version_length = VALUE.unpack_from(self.map, value_offset)
+                    value_offset += VALUE.size
+                    matches.append((self.map[value_offset:value_offset + version_length].decode('utf-8'), advisory_id, binary_package_id))
+                    value_offset += version_length
+                return matches
+        return []
+
+def index_path():
+    return getattr(settings, 'ADVISORY_MATCH_INDEX', '%s/advisory_cache/match.idx' % settings.BASE_DIR)
+
+_lock = threading.Lock()
+_index = None
+_checked = 0
+
+def get_index():
+    """
+    The current generation of the index, or None if there isn't one and matching has to use the database.
+    """
+
+    global _index, _checked
+    with _lock:
+        if time.time() - _checked < CHECK_INTERVAL:
+            return _index
+        _checked = time.time()
+
+        try:
+            stat = os.stat(index_path())
+        except OSError:
+            _index = None
+            return None
+
+        if _index is None or (stat.st_ino, stat.st_mtime_ns) != (_index.stat.st_ino, _index.stat.st_mtime_ns):
+            try:
+                _index = MatchIndex(index_path())
+            except (OSError, ValueError):
+                _index = None
+        return _index
+
+def discard():
+    """
+    Remove the index, e.g. when advisory packages it refers to are deleted, so matching falls back to the database until
+    the next rebuild.
+    """
+
+    global _index
+    with _lock:
+        _index = None
+        try:
+            os.remove(index_path())
+        except OSError:
+            pass
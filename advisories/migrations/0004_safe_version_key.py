@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from api.versions import version_key
+
+
+def populate_safe_version_keys(apps, schema_editor):
+    for model_name in ('SourcePackage', 'BinaryPackage'):
+        model = apps.get_model('advisories', model_name)
+        for safe_version in model.objects.values_list('safe_version', flat=True).distinct().iterator():
+            model.objects.filter(safe_version=safe_version).update(safe_version_key=version_key(safe_version))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advisories', '0003_auto_20171120_2136'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='binarypackage',
+            name='safe_version_key',
+            field=models.CharField(help_text='Collation key for the safe version, so versions can be compared by the database', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='sourcepackage',
+            name='safe_version_key',
+            field=models.CharField(help_text='Collation key for the safe version, so versions can be compared by the database', max_length=255, null=True),
+        ),
+        migrations.RunPython(populate_safe_version_keys, migrations.RunPython.noop),
+    ]
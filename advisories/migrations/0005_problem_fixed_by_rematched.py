@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 10:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advisories', '0004_safe_version_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='problem',
+            name='fixed_by',
+            field=models.CharField(choices=[('removed', 'Package removed'), ('rematched', 'No longer applicable')], help_text='Way in which the problem was resolved', max_length=200, null=True),
+        ),
+    ]
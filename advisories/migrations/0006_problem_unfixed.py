@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_fixed_problems(apps, schema_editor):
+    Problem = apps.get_model('advisories', 'Problem')
+    Problem.objects.filter(fixed__isnull=False).update(unfixed=None)
+
+    # racing get_or_create calls may have left duplicate open problems behind, keep the first of each
+    seen = set()
+    duplicates = []
+    for problem in Problem.objects.filter(unfixed=True).order_by('id').values_list('id', 'advisory_id', 'host_id', 'installed_package_name', 'installed_package_version', 'installed_package_architecture', 'safe_package_id').iterator():
+        if problem[1:] in seen:
+            duplicates.append(problem[0])
+        else:
+            seen.add(problem[1:])
+    for start in range(0, len(duplicates), 500):
+        Problem.objects.filter(id__in=duplicates[start:start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advisories', '0005_problem_fixed_by_rematched'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problem',
+            name='unfixed',
+            field=models.NullBooleanField(default=True, editable=False, help_text='True while the problem is open, otherwise NULL'),
+        ),
+        migrations.RunPython(mark_fixed_problems, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='problem',
+            unique_together=set([('advisory', 'host', 'installed_package_name', 'installed_package_version', 'installed_package_architecture', 'safe_package', 'unfixed')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advisories', '0007_problem_fixed_by_upgraded'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='binarypackage',
+            index_together=set([('package', 'release', 'architecture'), ('release', 'architecture')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='problem',
+            index_together=set([('host', 'installed_package_name', 'installed_package_version', 'installed_package_architecture'), ('host', 'safe_package', 'unfixed'), ('safe_package', 'unfixed')]),
+        ),
+    ]
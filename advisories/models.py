@@ -1,14 +1,24 @@
-import apt_pkg
-apt_pkg.init_system()
+import functools
+import operator
+import threading
+
+from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Q
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
 from api.models import *
+from api.ingest import BATCH_SIZE, chunks
+from api.signals import host_platform_changed, hosts_removed, packages_added, packages_removed, packages_upgraded
+from api.teardown import ROW_BATCH_SIZE, delete_in_batches
+from api.versions import VERSION_KEY_LENGTH, version_compare, version_key
+
+from . import bloom, matchindex
 
 class Advisory(models.Model):
     """
@@ -55,11 +65,16 @@ class SourcePackage(models.Model):
     package = models.CharField(max_length=200, help_text="Name of source package")
     release = models.CharField(choices=settings.RELEASES, max_length=32, help_text="Specific release to which this package belongs")
     safe_version = models.CharField(max_length=200, help_text="Package version that is to be considered 'safe' at the issue of this advisory")
+    safe_version_key = models.CharField(max_length=VERSION_KEY_LENGTH, null=True, help_text="Collation key for the safe version, so versions can be compared by the database")
 
     class Meta:
         verbose_name_plural = "source packages"
         ordering = ["-package"]
 
+    def save(self, *args, **kwargs):
+        self.safe_version_key = version_key(self.safe_version)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         safe_version = self.safe_version
 
@@ -90,11 +105,17 @@ class BinaryPackage(models.Model):
     package = models.CharField(max_length=200, help_text="Name of binary package")
     release = models.CharField(choices=settings.RELEASES, max_length=32, help_text="Specific release to which this package belongs")
     safe_version = models.CharField(max_length=200, null=True, help_text="Package version that is to be considered 'safe' at the issue of this advisory")
+    safe_version_key = models.CharField(max_length=VERSION_KEY_LENGTH, null=True, help_text="Collation key for the safe version, so versions can be compared by the database")
     architecture = models.CharField(max_length=200, null=True, help_text="Machine architecture")
 
     class Meta:
         verbose_name_plural = "binary packages"
         ordering = ["-package"]
+        index_together = (("package", "release", "architecture"), ("release", "architecture"))
+
+    def save(self, *args, **kwargs):
+        self.safe_version_key = version_key(self.safe_version)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         if self.safe_version:
@@ -126,9 +147,49 @@ class Vulnerability(models.Model):
     def source_list(self):
         return ", ".join(sorted([str(advisory).capitalize() for advisory in self.advisories.values_list('source', flat=True).distinct().order_by()]))
 
+PROBLEM_IDENTITY = ('advisory_id', 'host_id', 'installed_package_name', 'installed_package_version', 'installed_package_architecture', 'safe_package_id')
+
+class ProblemQuerySet(models.QuerySet):
+    def ensure_open(self, problems):
+        """
+        Make sure there is an open problem matching each of a list of unsaved problems, inserting only the ones that
+        aren't open already in bulk. Returns the problems that were inserted.
+        """
+
+        wanted = {problem.identity(): problem for problem in problems}
+        for batch in chunks(list(wanted.values())):
+            for identity in self.model.objects.filter(host_id__in={problem.host_id for problem in batch}, safe_package_id__in={problem.safe_package_id for problem in batch}, unfixed=True).values_list(*PROBLEM_IDENTITY):
+                wanted.pop(identity, None)
+
+        created = list(wanted.values())
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        except IntegrityError: # someone else opened some of them in the meantime, so go one at a time
+            created = []
+            for problem in wanted.values():
+                problem.pk = None
+                try:
+                    with transaction.atomic():
+                        problem.save()
+                    created.append(problem)
+                except IntegrityError:
+                    pass
+        return created
+
+    def close(self, fixed_by):
+        """
+        Mark every open problem in the queryset as fixed.
+        """
+
+        return self.filter(unfixed=True).update(fixed=timezone.now(), fixed_by=fixed_by, unfixed=None)
+
 class Problem(models.Model):
     """
     Records the details around why a host is affected by an advisory.
+
+    Only one problem with a given identity can be open at once. unfixed is True while a problem is open and NULL after,
+    as NULLs don't collide in the unique constraint, which allows any number of fixed problems alongside.
     """
 
     advisory = models.ForeignKey(Advisory, help_text="Advisory that has caused this problem")
@@ -140,31 +201,105 @@ class Problem(models.Model):
     created = models.DateTimeField(auto_now_add=True, verbose_name="Discovered")
     fixed = models.DateTimeField(null=True)
     fixed_by = models.CharField(null=True, choices=settings.FIX_REASONS, max_length=200, help_text="Way in which the problem was resolved")
+    unfixed = models.NullBooleanField(default=True, editable=False, help_text="True while the problem is open, otherwise NULL")
+
+    objects = ProblemQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (("advisory", "host", "installed_package_name", "installed_package_version", "installed_package_architecture", "safe_package", "unfixed"),)
+        index_together = (("host", "installed_package_name", "installed_package_version", "installed_package_architecture"), ("host", "safe_package", "unfixed"), ("safe_package", "unfixed"))
 
     def __str__(self):
         return "%s: %s %s on %s" % (self.advisory, self.installed_package_name, self.installed_package_version, self.host)
 
+    def save(self, *args, **kwargs):
+        self.unfixed = True if self.fixed is None else None
+        super().save(*args, **kwargs)
+
+    def identity(self):
+        return tuple(getattr(self, field) for field in PROBLEM_IDENTITY)
+
     def is_fixed(self):
         return self.fixed is not None and timezone.now() >= self.fixed
     is_fixed.boolean = True
 
+def version_is_older(version, safe_version, version_key=None, safe_version_key=None):
+    """
+    Whether an installed version is older than a safe version, comparing collation keys when both versions have one.
+    """
+
+    if version_key is not None and safe_version_key is not None:
+        return version_key < safe_version_key
+    return version_compare(version, safe_version) < 0
+
+_pending = threading.local()
+
 @receiver(post_save, sender=BinaryPackage)
 def cache_applicable_hosts_for_advisory_package(sender, **kwargs):
     """
     When a new package is added to an advisory work out what hosts it applies to.
+
+    This is left until the advisory's transaction commits, so every package the advisory brings is matched together.
     """
 
-    advisory_package = kwargs.get('instance')
-    advisory = advisory_package.advisory
-    print("Considering advisory package %s (%s)" % (advisory_package.package, advisory_package.architecture))
-    affected_packages = Package.objects.filter(name=advisory_package.package, architecture=advisory_package.architecture, host__release=advisory_package.release)
-    for package in affected_packages:
-        unsafe = apt_pkg.version_compare(package.version, advisory_package.safe_version) < 0
-        print("%s installed on %s is unsafe=%r due to installed version %s being <= %s" %(package.name, package.host, unsafe, package.version, advisory_package.safe_version))
-        if unsafe:
-            Problem.objects.get_or_create(advisory=advisory, host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture, safe_package=advisory_package, fixed__isnull=True)
-        else: # remove any problems that might have existed due to older incarnations of this advisory
-            Problem.objects.filter(advisory=advisory, host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture, safe_package=advisory_package).delete()
+    if not hasattr(_pending, 'advisory_packages'):
+        _pending.advisory_packages = set()
+    _pending.advisory_packages.add(kwargs.get('instance').id)
+    transaction.on_commit(match_pending_advisory_packages)
+
+def match_pending_advisory_packages():
+    advisory_package_ids = getattr(_pending, 'advisory_packages', set())
+    _pending.advisory_packages = set()
+    if advisory_package_ids: # otherwise an earlier callback for the same transaction got them all
+        match_advisory_packages(advisory_package_ids)
+
+def match_advisory_packages(advisory_package_ids):
+    """
+    Work out which hosts a set of advisory packages applies to, with one grouped query per batch of packages, and create
+    or remove problems in bulk.
+    """
+
+    advisory_packages = {}
+    for batch in chunks(advisory_package_ids):
+        advisory_packages.update((advisory_package.id, advisory_package) for advisory_package in BinaryPackage.objects.filter(id__in=batch))
+    print("Considering %i advisory packages" % len(advisory_packages))
+
+    # each distinct installed version is judged once, however many hosts have it
+    verdicts = {}
+    for batch in chunks(advisory_packages.values()):
+        groups = {}
+        conditions = []
+        for advisory_package in batch:
+            groups.setdefault((advisory_package.package, advisory_package.architecture, advisory_package.release), []).append(advisory_package)
+            condition = Q(name=advisory_package.package, architecture=advisory_package.architecture, release=advisory_package.release)
+            if advisory_package.safe_version_key is not None: # let the database rule out the versions it can
+                condition &= Q(version_key__lt=advisory_package.safe_version_key) | Q(version_key__isnull=True)
+            conditions.append(condition)
+
+        for name, version, key, architecture, release in Package.objects.filter(functools.reduce(operator.or_, conditions)).values_list('name', 'version', 'version_key', 'architecture', 'release').distinct():
+            older = [advisory_package for advisory_package in groups.get((name, architecture, release), []) if version_is_older(version, advisory_package.safe_version, key, advisory_package.safe_version_key)]
+            if older:
+                verdicts.setdefault((name, version, architecture, release), []).extend(older)
+
+    # then the verdicts are handed out to the hosts that have those versions
+    unsafe = []
+    for batch in chunks(verdicts):
+        condition = functools.reduce(operator.or_, (Q(name=name, version=version, architecture=architecture, release=release) for name, version, architecture, release in batch))
+        for host_id, name, version, architecture, release in Package.objects.filter(condition).values_list('host_id', 'name', 'version', 'architecture', 'release'):
+            for advisory_package in verdicts[(name, version, architecture, release)]:
+                unsafe.append((host_id, name, version, architecture, advisory_package))
+
+    stale_problems = []
+    for batch in chunks(advisory_packages):
+        for problem_id, version, safe_package_id in Problem.objects.filter(safe_package_id__in=batch).values_list('id', 'installed_package_version', 'safe_package_id'):
+            if not version_is_older(version, advisory_packages[safe_package_id].safe_version): # left over from an older incarnation of this advisory
+                stale_problems.append(problem_id)
+
+    for batch in chunks(stale_problems):
+        Problem.objects.filter(id__in=batch).delete()
+
+    problems = Problem.objects.ensure_open([Problem(advisory_id=advisory_package.advisory_id, host_id=host_id, installed_package_name=name, installed_package_version=version, installed_package_architecture=architecture, safe_package=advisory_package) for host_id, name, version, architecture, advisory_package in unsafe])
+    print("%i new problems found on %i hosts" % (len(problems), len({problem.host_id for problem in problems})))
 
 @receiver(post_save, sender=Package)
 def add_package_to_host(sender, **kwargs):
@@ -174,13 +309,13 @@ def add_package_to_host(sender, **kwargs):
 
     package = kwargs.get('instance')
     print("installed %s on %s" % (package, package.host))
-    advisory_packages = BinaryPackage.objects.filter(package=package.name, architecture=package.architecture, release=package.host.release)
+    advisory_packages = BinaryPackage.objects.filter(package=package.name, architecture=package.architecture, release=package.release)
     for advisory_package in advisory_packages:
         advisory = advisory_package.advisory
-        unsafe = apt_pkg.version_compare(package.version, advisory_package.safe_version) < 0
+        unsafe = version_compare(package.version, advisory_package.safe_version) < 0
         print("%s installed on %s is unsafe=%r due to installed version %s being <= %s" %(package.name, package.host, unsafe, package.version, advisory_package.safe_version))
         if unsafe:
-            Problem.objects.get_or_create(advisory=advisory, host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture, safe_package=advisory_package, fixed__isnull=True)
+            Problem.objects.ensure_open([Problem(advisory=advisory, host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture, safe_package=advisory_package)])
 
 @receiver(pre_delete, sender=Package)
 def remove_package_from_host(sender, **kwargs):
@@ -190,5 +325,264 @@ def remove_package_from_host(sender, **kwargs):
 
     package = kwargs.get('instance')
     print("removed %s from %s" % (package, package.host))
-    Problem.objects.filter(host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture).update(fixed=timezone.now(), fixed_by='removed')
+    Problem.objects.filter(host=package.host, installed_package_name=package.name, installed_package_version=package.version, installed_package_architecture=package.architecture).close('removed')
+
+
+def advisory_packages_for(release, installed):
+    """
+    Yield (name, architecture, installed version, safe version, advisory id, binary package id) for every advisory package
+    naming one of the installed {(name, architecture): version} packages in a release.
+
+    Packages the package filter rules out are skipped. The compiled match index is used when there is one, otherwise the
+    database is asked.
+    """
+
+    package_filter = bloom.get_filter()
+    if package_filter is not None: # skip packages that have certainly never been in an advisory
+        installed = {(name, architecture): version for (name, architecture), version in installed.items() if package_filter.might_contain(release, architecture, name)}
+
+    index = matchindex.get_index()
+    if index is not None:
+        for (name, architecture), version in installed.items():
+            for safe_version, advisory_id, binary_package_id in index.lookup(release, architecture, name):
+                yield name, architecture, version, safe_version, advisory_id, binary_package_id
+        return
+
+    for batch in chunks({name for name, architecture in installed}):
+        for advisory_package in BinaryPackage.objects.filter(package__in=batch, release=release):
+            version = installed.get((advisory_package.package, advisory_package.architecture))
+            if version is not None:
+                yield advisory_package.package, advisory_package.architecture, version, advisory_package.safe_version, advisory_package.advisory_id, advisory_package.id
+
+_verdicts = OrderedDict() # (release, architecture, name, version) -> advisory packages that version is older than
+_verdicts_index = None
+_verdicts_lock = threading.Lock()
+VERDICT_CACHE_SIZE = 100000
+
+def unsafe_advisory_packages(release, installed):
+    """
+    Yield (name, architecture, installed version, safe version, advisory id, binary package id) for every advisory package
+    that one of the installed {(name, architecture): version} packages in a release is older than.
+
+    While a match index is in use the verdict for each distinct (release, architecture, name, version) is remembered
+    until the next generation, so a version that many hosts share is only judged once.
+    """
+
+    global _verdicts_index
+    index = matchindex.get_index()
+    if index is None:
+        for name, architecture, version, safe_version, advisory_id, binary_package_id in advisory_packages_for(release, installed):
+            if version_is_older(version, safe_version):
+                yield name, architecture, version, safe_version, advisory_id, binary_package_id
+        return
+
+    unjudged = {}
+    judged = []
+    with _verdicts_lock:
+        if _verdicts_index is not index:
+            _verdicts.clear()
+            _verdicts_index = index
+        for (name, architecture), version in installed.items():
+            verdict = _verdicts.get((release, architecture, name, version))
+            if verdict is None:
+                unjudged[(name, architecture)] = version
+            else:
+                _verdicts.move_to_end((release, architecture, name, version))
+                judged.extend(verdict)
+    for row in judged:
+        yield row
+
+    verdicts = {(release, architecture, name, version): [] for (name, architecture), version in unjudged.items()}
+    for name, architecture, version, safe_version, advisory_id, binary_package_id in advisory_packages_for(release, unjudged):
+        if version_is_older(version, safe_version):
+            verdicts[(release, architecture, name, version)].append((name, architecture, version, safe_version, advisory_id, binary_package_id))
+
+    with _verdicts_lock:
+        if _verdicts_index is index:
+            _verdicts.update(verdicts)
+            while len(_verdicts) > VERDICT_CACHE_SIZE:
+                _verdicts.popitem(last=False)
+    for verdict in verdicts.values():
+        for row in verdict:
+            yield row
+
+def build_match_index():
+    """
+    Compile every advisory package in to the match index used when packages are installed on hosts.
+    """
+
+    return matchindex.build(matchindex.index_path(), BinaryPackage.objects.values_list('release', 'architecture', 'package', 'safe_version', 'advisory_id', 'id').iterator())
+
+def build_package_filter():
+    """
+    Rebuild the filter of (release, architecture, package) that have ever been in an advisory.
+    """
+
+    return bloom.build(bloom.filter_path(), BinaryPackage.objects.values_list('release', 'architecture', 'package').distinct().iterator())
+
+@receiver(post_save, sender=BinaryPackage)
+@receiver(post_delete, sender=BinaryPackage)
+def discard_match_index(sender, **kwargs):
+    """
+    When an advisory package is added, changed or removed stop using the match index, which doesn't know about the
+    change, until it is rebuilt.
+
+    It is discarded straight away, so other processes stop using it as soon as they next check, and again once the
+    change commits in case an index built without it has appeared in the meantime.
+    """
+
+    matchindex.discard()
+    transaction.on_commit(matchindex.discard)
+
+@receiver(post_save, sender=BinaryPackage)
+def discard_package_filter(sender, **kwargs):
+    """
+    When an advisory package is added or changed stop using the package filter, which would rule it out, until it is
+    rebuilt. Like the match index it is discarded straight away and again once the change commits.
+    """
+
+    bloom.discard()
+    transaction.on_commit(bloom.discard)
+
+@receiver(packages_added)
+def add_packages_to_host(sender, **kwargs):
+    """
+    When a batch of packages is added to a host find any advisories that apply to any of them and create problems, in a handful of queries.
+    """
+
+    host = kwargs.get('host')
+    installed = {(package.name, package.architecture): package.version for package in kwargs.get('packages')}
+    print("installed %i packages on %s" % (len(installed), host))
+
+    problems = []
+    for name, architecture, version, safe_version, advisory_id, binary_package_id in unsafe_advisory_packages(host.release, installed):
+        print("%s installed on %s is unsafe due to installed version %s being <= %s" %(name, host, version, safe_version))
+        problems.append(Problem(advisory_id=advisory_id, host=host, installed_package_name=name, installed_package_version=version, installed_package_architecture=architecture, safe_package_id=binary_package_id))
+
+    Problem.objects.ensure_open(problems)
+
+@receiver(packages_removed)
+def remove_packages_from_host(sender, **kwargs):
+    """
+    When a batch of packages is removed from a host find any problems removing them might solve.
+    """
+
+    host = kwargs.get('host')
+    packages = kwargs.get('packages')
+    print("removed %i packages from %s" % (len(packages), host))
+    for batch in chunks(packages):
+        query = functools.reduce(operator.or_, (Q(installed_package_name=name, installed_package_version=version, installed_package_architecture=architecture) for name, version, architecture in batch))
+        Problem.objects.filter(query, host=host).close('removed')
+
+@receiver(packages_upgraded)
+def upgrade_packages_on_host(sender, **kwargs):
+    """
+    When a batch of packages is upgraded in place on a host close the problems the previous versions had and find any
+    the new versions still have, in a handful of queries.
+    """
+
+    host = kwargs.get('host')
+    packages = kwargs.get('packages')
+    print("upgraded %i packages on %s" % (len(packages), host))
+    for batch in chunks(packages):
+        query = functools.reduce(operator.or_, (Q(installed_package_name=name, installed_package_version=previous_version, installed_package_architecture=architecture) for name, previous_version, version, architecture in batch))
+        Problem.objects.filter(query, host=host).close('upgraded')
+
+    installed = {(name, architecture): version for name, previous_version, version, architecture in packages}
+    problems = []
+    for name, architecture, version, safe_version, advisory_id, binary_package_id in unsafe_advisory_packages(host.release, installed):
+        print("%s upgraded on %s is still unsafe due to installed version %s being <= %s" %(name, host, version, safe_version))
+        problems.append(Problem(advisory_id=advisory_id, host=host, installed_package_name=name, installed_package_version=version, installed_package_architecture=architecture, safe_package_id=binary_package_id))
+
+    Problem.objects.ensure_open(problems)
+
+@receiver(hosts_removed)
+def remove_problems_from_hosts(sender, **kwargs):
+    """
+    When a batch of hosts is torn down delete their problems in bounded batches, as they can't outlive the hosts.
+    """
+
+    problems = Problem.objects.filter(host_id__in=kwargs.get('host_ids'))
+    delete_in_batches(problems, kwargs.get('batch_size', ROW_BATCH_SIZE)) # nothing refers to problems
+
+def expected_problems(release, architecture, host_ids=None, advisory_ids=None):
+    """
+    Work out from scratch which problems should be open for packages of one architecture on hosts running one release,
+    as a set of (advisory id, host id, name, version, architecture, binary package id).
+
+    Also returns the number of installed packages that were considered.
+    """
+
+    advisory_packages = BinaryPackage.objects.filter(release=release, architecture=architecture)
+    if advisory_ids is not None:
+        advisory_packages = advisory_packages.filter(advisory_id__in=advisory_ids)
+    by_name = {}
+    for advisory_package in advisory_packages.only('id', 'advisory_id', 'package', 'safe_version', 'safe_version_key'):
+        by_name.setdefault(advisory_package.package, []).append(advisory_package)
+
+    packages = Package.objects.filter(architecture=architecture, release=release)
+    if host_ids is not None:
+        packages = packages.filter(host_id__in=host_ids)
+
+    # each distinct installed version is judged once, however many hosts have it
+    verdicts = {}
+    considered = 0
+    for names in chunks(by_name):
+        for name, version, key, installs in packages.filter(name__in=names).values_list('name', 'version', 'version_key').annotate(installs=Count('id')).order_by().iterator():
+            considered += installs
+            older = [advisory_package for advisory_package in by_name[name] if version_is_older(version, advisory_package.safe_version, key, advisory_package.safe_version_key)]
+            if older:
+                verdicts[(name, version)] = older
+
+    # then the verdicts are handed out to the hosts that have those versions
+    expected = set()
+    for batch in chunks(verdicts):
+        condition = functools.reduce(operator.or_, (Q(name=name, version=version) for name, version in batch))
+        for host_id, name, version in packages.filter(condition).values_list('host_id', 'name', 'version').iterator():
+            for advisory_package in verdicts[(name, version)]:
+                expected.add((advisory_package.advisory_id, host_id, name, version, architecture, advisory_package.id))
+    return expected, considered
+
+def reconcile_problems(expected, open_problems, fixed_by='rematched', since=None):
+    """
+    Bring the open problems in a queryset in to line with a set from expected_problems(), creating the missing ones and
+    closing the ones that no longer apply, so problems that still apply keep their discovery time.
+
+    If expected was worked out from a snapshot taken at since, problems opened or closed after that are left as they
+    are, as they were changed by something that saw newer packages than the snapshot did.
+
+    Returns the number of problems created and closed.
+    """
+
+    existing = {}
+    changed = set()
+    for problem in open_problems.filter(unfixed=True).values_list('id', 'created', *PROBLEM_IDENTITY).iterator():
+        if since is not None and problem[1] >= since:
+            changed.add(problem[2:])
+        else:
+            existing[problem[2:]] = problem[0]
+    if since is not None:
+        changed.update(open_problems.filter(fixed__gte=since).values_list(*PROBLEM_IDENTITY).iterator())
+
+    closed = [problem_id for identity, problem_id in existing.items() if identity not in expected and identity not in changed]
+    for batch in chunks(closed):
+        Problem.objects.filter(id__in=batch).close(fixed_by)
+
+    created = Problem.objects.ensure_open([Problem(advisory_id=advisory_id, host_id=host_id, installed_package_name=name, installed_package_version=version, installed_package_architecture=architecture, safe_package_id=safe_package_id) for advisory_id, host_id, name, version, architecture, safe_package_id in expected if (advisory_id, host_id, name, version, architecture, safe_package_id) not in existing and (advisory_id, host_id, name, version, architecture, safe_package_id) not in changed])
+    return len(created), len(closed)
+
+@receiver(host_platform_changed)
+def rematch_host(sender, **kwargs):
+    """
+    When a host moves to another release or architecture re-match all of its packages, closing problems that no longer
+    apply and opening any new ones.
+    """
+
+    host = kwargs.get('host')
+    if not kwargs.get('previous_release') or not kwargs.get('previous_architecture'): # first inventory, matched as it's added
+        return
 
+    print("%s moved from %s/%s to %s/%s, re-matching its packages" % (host, kwargs.get('previous_release'), kwargs.get('previous_architecture'), host.release, host.architecture))
+    installed = {(name, architecture): version for name, architecture, version in Package.objects.filter(host=host).values_list('name', 'architecture', 'version').iterator()}
+    expected = {(advisory_id, host.pk, name, version, architecture, binary_package_id) for name, architecture, version, safe_version, advisory_id, binary_package_id in unsafe_advisory_packages(host.release, installed)}
+    reconcile_problems(expected, Problem.objects.filter(host=host))
@@ -0,0 +1,89 @@
+from django.conf import settings
+
+import gzip
+import json
+import os
+import threading
+import time
+
+PRUNE_AGE = 24 * 60 * 60 # seconds an unused map is kept for, in case another feed is still using it
+
+def cache_location():
+    return getattr(settings, 'ADVISORY_PACKAGE_MAP_CACHE', '%s/advisory_cache/packagemap' % settings.BASE_DIR)
+
+def _path(digest):
+    return '%s/%s.json.gz' % (cache_location(), digest)
+
+def parse(paragraphs):
+    """
+    (source package, source version, binary package, binary version) for each binary package in a Packages file.
+    """
+
+    rows = []
+    for binary_package in paragraphs:
+        source_field = binary_package.get('Source', binary_package['Package']).split()
+        source_package_name = source_field[0]
+
+        try:
+            source_package_version = source_field[1].strip('()')
+        except IndexError:
+            source_package_version = binary_package['Version']
+
+        rows.append((source_package_name, source_package_version, binary_package['Package'], binary_package['Version']))
+    return rows
+
+_lock = threading.Lock()
+_loaded = {} # digest -> rows, so every feed in a process shares one copy
+
+def load(digest):
+    """
+    Rows parsed from the Packages file with a given SHA256, or None if it hasn't been seen before.
+    """
+
+    with _lock:
+        if digest in _loaded:
+            return _loaded[digest]
+
+    try:
+        with gzip.open(_path(digest), 'rt', encoding='utf-8') as map_file:
+            rows = [tuple(row) for row in json.load(map_file)]
+    except (OSError, ValueError):
+        return None
+
+    os.utime(_path(digest)) # still in use, so not to be pruned
+    with _lock:
+        _loaded[digest] = rows
+    return rows
+
+def save(digest, rows):
+    try:
+        os.makedirs(cache_location())
+    except OSError: # directory already exists
+        pass
+
+    incoming = '%s.incoming' % _path(digest)
+    with gzip.open(incoming, 'wt', encoding='utf-8') as map_file:
+        json.dump(rows, map_file, separators=(',', ':'))
+    os.replace(incoming, _path(digest))
+    with _lock:
+        _loaded[digest] = rows
+
+def prune(keep):
+    """
+    Remove maps for Packages files other than those with the SHA256s in keep that haven't been used for a while.
+    """
+
+    try:
+        names = os.listdir(cache_location())
+    except OSError:
+        return
+
+    for name in names:
+        if name.split('.')[0] in keep:
+            continue
+        path = '%s/%s' % (cache_location(), name)
+        try:
+            if time.time() - os.stat(path).st_mtime > PRUNE_AGE:
+                os.remove(path)
+        except OSError:
+            pass
@@ -1,3 +1,90 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-# Create your tests here.
+from api.ingest import add_packages
+from api.models import Host
+from api.tests import QueryPlanTestCase
+
+from .models import Advisory, BinaryPackage, Problem, build_match_index, build_package_filter
+from . import bloom, matchindex
+
+import shutil
+import tempfile
+
+class MatchingTests(TestCase):
+    def setUp(self):
+        cache_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_location)
+        paths = override_settings(ADVISORY_MATCH_INDEX='%s/match.idx' % cache_location, ADVISORY_FILTER='%s/match.bloom' % cache_location)
+        paths.enable()
+        self.addCleanup(paths.disable)
+        for module in (matchindex, bloom): # forget whatever an earlier test loaded
+            module._checked = 0
+        matchindex._index = bloom._filter = None
+
+        self.advisory = Advisory.objects.create(upstream_id='DSA-1-1', source='debian')
+        BinaryPackage.objects.create(advisory=self.advisory, package='bash', release='jessie', safe_version='4.3-11+deb8u1', architecture='amd64')
+        self.host = Host.objects.create(node_key='0' * 32, identifier='test', ram=0, cpu='', release='jessie', architecture='x86_64')
+
+    def load(self, module, getter):
+        """
+        The current generation of the index or filter, checking for a new one now.
+        """
+        module._checked = 0 # don't wait for the next check
+        return getter()
+
+    def assertMatched(self, name, version):
+        add_packages(self.host, [(name, version, 'amd64')])
+        self.assertTrue(Problem.objects.filter(host=self.host, installed_package_name=name, installed_package_version=version, unfixed=True).exists())
+
+    def test_matched_from_index(self):
+        build_match_index()
+        self.assertIsNotNone(self.load(matchindex, matchindex.get_index))
+        self.assertMatched('bash', '4.3-11')
+
+    def test_advisory_package_saved_after_index_build_is_matched(self):
+        build_match_index()
+        self.assertIsNotNone(self.load(matchindex, matchindex.get_index))
+
+        BinaryPackage.objects.create(advisory=self.advisory, package='openssl', release='jessie', safe_version='1.0.1t-1+deb8u7', architecture='amd64')
+        self.assertIsNone(self.load(matchindex, matchindex.get_index))
+        self.assertMatched('openssl', '1.0.1t-1+deb8u6')
+
+    def test_advisory_package_saved_after_filter_build_is_matched(self):
+        build_package_filter()
+        self.assertIsNotNone(self.load(bloom, bloom.get_filter))
+
+        BinaryPackage.objects.create(advisory=self.advisory, package='openssl', release='jessie', safe_version='1.0.1t-1+deb8u7', architecture='amd64')
+        self.assertIsNone(self.load(bloom, bloom.get_filter))
+        self.assertMatched('openssl', '1.0.1t-1+deb8u6')
+
+class MatchingQueryTests(QueryPlanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.advisory = Advisory.objects.create(upstream_id='DSA-1-1', source='debian')
+        self.advisory_packages = [BinaryPackage.objects.create(advisory=self.advisory, package='package%i' % index, release=release, safe_version='2.0-1', architecture='amd64') for index in range(20) for release in ('jessie', 'stretch')]
+        self.host = Host.objects.create(node_key='0' * 32, identifier='test', ram=0, cpu='', release='jessie', architecture='x86_64')
+        add_packages(self.host, [('package%i' % index, '1.0-1', 'amd64') for index in range(20)])
+
+    def test_installed_package_query(self):
+        """
+        The query for the advisory packages that apply to one installed package.
+        """
+
+        advisory_packages = BinaryPackage.objects.filter(package='package3', architecture='amd64', release='jessie')
+        self.assertUsesIndex(advisory_packages, BinaryPackage, ('package', 'release', 'architecture'))
+
+    def test_open_problems_query(self):
+        """
+        The query ensure_open makes for the problems already open among a batch.
+        """
+
+        problems = Problem.objects.filter(host_id__in=[self.host.id], safe_package_id__in=[advisory_package.id for advisory_package in self.advisory_packages[:4]], unfixed=True)
+        self.assertUsesIndex(problems, Problem, ('host_id', 'safe_package_id', 'unfixed'))
+
+    def test_removed_package_query(self):
+        """
+        The query for the problems caused by a package that has been removed from a host.
+        """
+
+        problems = Problem.objects.filter(host=self.host, installed_package_name='package3', installed_package_version='1.0-1', installed_package_architecture='amd64')
+        self.assertUsesIndex(problems, Problem, ('host_id', 'installed_package_name', 'installed_package_version', 'installed_package_architecture'))
@@ -26,7 +26,7 @@ class LogEntryInline(admin.TabularInline):
     extra = 0 
 
 class HostAdmin(admin.ModelAdmin):
-    list_display = ('identifier', 'release', 'architecture', 'cpu', 'ram_gib', 'last_seen', 'alive')
+    list_display = ('identifier', 'release', 'architecture', 'cpu', 'ram_gib', 'seen', 'alive')
     inlines = [
         LogEntryInline,
     ]
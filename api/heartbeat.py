@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, DateTimeField, Value, When
+
+import atexit
+import threading
+import time
+
+_lock = threading.Lock()
+_pending = {} # host id -> last_seen not yet written to the database
+_flusher = None
+
+def beat(host, seen):
+    """
+    Record that a host has checked in.
+
+    The new last_seen is held in memory and written for every host at once by flush(), which a background thread does
+    every OSQUERY_HEARTBEAT_INTERVAL seconds, so it never happens inside a request's transaction.
+    """
+
+    host.last_seen = seen
+    with _lock:
+        _pending[host.pk] = seen
+    _start_flusher()
+
+def last_seen(host_id):
+    """
+    The last_seen for a host that is waiting to be written, if any.
+    """
+
+    with _lock:
+        return _pending.get(host_id)
+
+def flush():
+    """
+    Write every buffered last_seen to the database in bulk updates, each committed on its own.
+
+    Hosts are only dropped from the buffer once they have been written, and are written in id order so processes
+    flushing at the same time take their row locks in the same order.
+    """
+
+    from .ingest import chunks
+    from .models import Host
+
+    with _lock:
+        pending = sorted(_pending.items())
+
+    for batch in chunks(pending):
+        Host.objects.filter(pk__in=[host_id for host_id, seen in batch]).update(last_seen=Case(*[When(pk=host_id, then=Value(seen)) for host_id, seen in batch], output_field=DateTimeField()))
+        with _lock:
+            for host_id, seen in batch:
+                if _pending.get(host_id) == seen: # not checked in again since
+                    del _pending[host_id]
+
+def _flush_periodically():
+    while True:
+        time.sleep(getattr(settings, 'OSQUERY_HEARTBEAT_INTERVAL', 30))
+        try:
+            flush()
+        except Exception as e: # left buffered for the next attempt
+            print("could not write host check ins: %r" % e)
+        finally:
+            connection.close() # this thread's own connection, not to be held open between flushes
+
+def _start_flusher():
+    global _flusher
+    with _lock:
+        if _flusher is None or not _flusher.is_alive(): # not started yet, or lost in a fork
+            _flusher = threading.Thread(target=_flush_periodically, name='heartbeat-flush', daemon=True)
+            _flusher.start()
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception: # database may already be gone
+        pass
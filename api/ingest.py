@@ -0,0 +1,190 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, Q, Value, When
+
+from .models import *
+from .signals import packages_added, packages_removed, packages_upgraded
+from .versions import version_key
+
+import functools
+import itertools
+import operator
+
+BATCH_SIZE = 500
+ENTRY_BATCH_SIZE = 5000 # log entries applied at a time, which bounds memory when they are streamed
+
+def chunks(items, size=BATCH_SIZE):
+    """
+    Split items in to lists of at most size entries, to keep IN clauses and bulk inserts a sensible length.
+    """
+
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def add_packages(host, rows):
+    """
+    Insert every (name, version, architecture) in rows for a host with set-based inserts, ignoring any the host already has.
+    """
+
+    wanted = {}
+    for name, version, architecture in rows:
+        wanted.setdefault((name, architecture), version) # first row wins, as the unique constraint used to decide
+
+    existing = set()
+    for names in chunks({name for name, architecture in wanted}):
+        existing.update(Package.objects.filter(host=host, name__in=names).values_list('name', 'architecture'))
+
+    packages = [Package(name=name, host=host, version=version, version_key=version_key(version), architecture=architecture, release=host.release) for (name, architecture), version in wanted.items() if (name, architecture) not in existing]
+    try:
+        with transaction.atomic():
+            Package.objects.bulk_create(packages, batch_size=BATCH_SIZE)
+    except IntegrityError: # another request for the same host got some of them in first, so go one at a time
+        inserted = []
+        for package in packages:
+            package.pk = None
+            try:
+                with transaction.atomic():
+                    Package.objects.bulk_create([package])
+                inserted.append(package)
+            except IntegrityError:
+                pass
+        packages = inserted
+    if packages:
+        packages_added.send(sender=Package, host=host, packages=packages)
+    return packages
+
+def remove_packages(host, rows):
+    """
+    Delete every (name, version, architecture) in rows from a host with set-based deletes.
+
+    This skips the per-row pre_delete signal, receivers of packages_removed are expected to do the same work for the whole batch.
+    """
+
+    removed = []
+    for batch in chunks(set(rows)):
+        query = functools.reduce(operator.or_, (Q(name=name, version=version, architecture=architecture) for name, version, architecture in batch))
+        removed.extend(Package.objects.filter(query, host=host).values_list('id', 'name', 'version', 'architecture'))
+
+    if removed:
+        packages_removed.send(sender=Package, host=host, packages=[(name, version, architecture) for package_id, name, version, architecture in removed])
+        for ids in chunks([package_id for package_id, name, version, architecture in removed]):
+            queryset = Package.objects.filter(id__in=ids)
+            queryset._raw_delete(queryset.db) # nothing refers to packages, so there is nothing to cascade
+    return removed
+
+def upgrade_packages(host, rows):
+    """
+    Move every (name, previous version, version, architecture) in rows on to its new version in place, with one
+    set-based update per batch rather than a delete and an insert.
+
+    Returns the rows whose previous version the host didn't have, which are left for the caller to add instead.
+    """
+
+    upgrades = {(name, previous_version, architecture): version for name, previous_version, version, architecture in rows}
+
+    found = []
+    for batch in chunks(upgrades):
+        query = functools.reduce(operator.or_, (Q(name=name, version=previous_version, architecture=architecture) for name, previous_version, architecture in batch))
+        found.extend(Package.objects.filter(query, host=host).values_list('id', 'name', 'version', 'architecture'))
+
+    for batch in chunks(found):
+        versions = [(package_id, upgrades[(name, previous_version, architecture)]) for package_id, name, previous_version, architecture in batch]
+        Package.objects.filter(id__in=[package_id for package_id, version in versions]).update(
+            version=Case(*[When(id=package_id, then=Value(version)) for package_id, version in versions], output_field=CharField()),
+            version_key=Case(*[When(id=package_id, then=Value(version_key(version))) for package_id, version in versions], output_field=CharField()),
+        )
+
+    if found:
+        packages_upgraded.send(sender=Package, host=host, packages=[(name, previous_version, upgrades[(name, previous_version, architecture)], architecture) for package_id, name, previous_version, architecture in found])
+
+    for package_id, name, previous_version, architecture in found:
+        del upgrades[(name, previous_version, architecture)]
+    return [(name, previous_version, version, architecture) for (name, previous_version, architecture), version in upgrades.items()]
+
+def process_results(host, entries):
+    """
+    Apply osquery "result" log entries to a host, which may be a list or an iterator that parses them as it goes.
+    """
+
+    for batch in chunks(entries, ENTRY_BATCH_SIZE):
+        process_result_batch(host, batch)
+
+def process_result_batch(host, entries):
+    """
+    Apply a batch of osquery "result" log entries to a host.
+
+    Package rows are collected across the whole batch and written once at the end. A removal and an addition of the
+    same package in one batch is an upgrade, and the row is updated in place. Any other removals are done before the
+    additions, so a removal and addition split across batches doesn't trip over the unique constraint either, as
+    osquery sends the removed rows of a diff before the added ones.
+    """
+
+    added_packages = []
+    removed_packages = []
+    log_entries = []
+
+    host.identifier = entries[0]['hostIdentifier']
+    for submitted_log_entry in entries:
+        entry_name = submitted_log_entry['name']
+        entry_action = submitted_log_entry['action']
+
+        recognised_action = False
+        if entry_action == 'added':
+            entry_output = submitted_log_entry['columns']
+            if entry_name == "hotplatehosts_os-version":
+                host.release = entry_output['version'].split()[-1].strip('()')
+                recognised_action = True
+            elif entry_name == "hotplatehosts_osrelease":
+                host.architecture = entry_output['current_value'].split('-')[-1]
+                recognised_action = True
+            elif entry_name == "hotplatehosts_deb-packages":
+                added_packages.append((entry_output['name'], entry_output['version'], entry_output['arch']))
+                recognised_action = True
+
+        elif entry_action == 'removed':
+            entry_output = submitted_log_entry['columns']
+            if entry_name == "hotplatehosts_deb-packages":
+                recognised_action = True
+                removed_packages.append((entry_output['name'], entry_output['version'], entry_output['arch']))
+
+        elif entry_action == 'snapshot': # full snapshot query
+            entry_outputs = submitted_log_entry['snapshot']
+            for entry_output in entry_outputs:
+                if entry_name == "hotplatehosts_system-info":
+                    host.cpu = entry_output['cpu_brand']
+                    host.ram = int(entry_output['physical_memory'])
+
+        if recognised_action == False and entry_action in ('added', 'removed') and entry_name.startswith('hotplatehosts_db_'): # just log in to the db
+            log_entries.append(LogEntry(name=entry_name[17:], action=entry_action, output=repr(entry_output), host=host))
+
+    # pair off removals and additions of the same package
+    additions = {}
+    for name, version, architecture in added_packages:
+        additions.setdefault((name, architecture), version)
+    upgraded_packages = []
+    for name, previous_version, architecture in set(removed_packages):
+        version = additions.get((name, architecture))
+        if version is not None and version != previous_version:
+            upgraded_packages.append((name, previous_version, version, architecture))
+            del additions[(name, architecture)]
+    upgraded = {(name, previous_version, architecture) for name, previous_version, version, architecture in upgraded_packages}
+
+    remove_packages(host, [package for package in removed_packages if package not in upgraded])
+    missed = upgrade_packages(host, upgraded_packages)
+    add_packages(host, [(name, version, architecture) for (name, architecture), version in additions.items()] + [(name, version, architecture) for name, previous_version, version, architecture in missed])
+    LogEntry.objects.bulk_create(log_entries, batch_size=BATCH_SIZE)
+
+def process_log(host, form):
+    """
+    Apply a decoded logger payload to a host and save it.
+    """
+
+    if form['log_type'] == 'result': # a "change" on a query
+        process_results(host, form['data'])
+
+    # last_seen is written by the heartbeat buffer, and anything the payload didn't touch may not even be loaded
+    deferred = host.get_deferred_fields()
+    host.save(update_fields=[field for field in ('identifier', 'release', 'architecture', 'cpu', 'ram') if field not in deferred])
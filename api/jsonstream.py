@@ -0,0 +1,152 @@
+import codecs
+import json
+import re
+
+_string_end = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_structure = re.compile(r'["{}\[\]]')
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number = re.compile(r'[-+0-9.eE]*')
+_number_start = set('-0123456789')
+
+class JSONStream(object):
+    """
+    Incremental reader for a JSON document on a binary file-like object.
+
+    Objects and arrays can be walked one member at a time with iter_object() and iter_array(), and each member is either
+    parsed with read_value() or passed over with skip_value(), so only the parts of a document that are wanted are ever
+    turned in to Python objects.
+    """
+
+    def __init__(self, raw, chunk_size=64 * 1024):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Read another chunk in to the buffer, returning False at the end of the document.
+        """
+
+        if self.eof:
+            return False
+        if self.pos > self.chunk_size: # drop what has already been consumed
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        data = self.raw.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buffer += self.decoder.decode(data or b'', final=self.eof)
+        return True
+
+    def _peek(self):
+        """
+        The next significant character, or '' at the end of the document.
+        """
+
+        while True:
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character == '' or character not in characters:
+            raise ValueError("expected one of %r at offset %i, got %r" % (characters, self.pos, character))
+        self.pos += 1
+        return character
+
+    def read_value(self):
+        """
+        Parse the next value in full.
+        """
+
+        self._peek()
+        while True:
+            # a number that runs to the end of the buffer may carry on in to the next chunk, and a part of it such as
+            # "1" of "1.5" would otherwise parse
+            if self.buffer[self.pos:self.pos + 1] in _number_start and _number.match(self.buffer, self.pos).end() == len(self.buffer) and self._fill():
+                continue
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """
+        Move past the next value without building it.
+        """
+
+        if self._peek() not in '{[':
+            self.read_value()
+            return
+
+        depth = 0
+        while True:
+            match = _structure.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError("unexpected end of document")
+                continue
+
+            character = match.group()
+            if character == '"':
+                self.pos = match.start() # keep the whole string in the buffer while more is read
+                while True:
+                    string_end = _string_end.match(self.buffer, self.pos + 1)
+                    if string_end is not None:
+                        self.pos = string_end.end()
+                        break
+                    if not self._fill():
+                        raise ValueError("unterminated string")
+                continue
+
+            self.pos = match.end()
+            if character in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iter_object(self):
+        """
+        Yield each key of the next object. The caller must read or skip the value of each key before asking for the next.
+        """
+
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("object key is not a string")
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """
+        Yield each value of the next array in turn.
+        """
+
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self._expect(',]') == ']':
+                return
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.ingest import process_log
+from api.models import Host
+from api.spool import get_spool
+
+import json
+import threading
+import time
+
+class Command(BaseCommand):
+    help = 'Process logger payloads waiting in the spool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Number of worker threads, hosts are sharded between them')
+        parser.add_argument('--batch-size', type=int, default=100, help='Payloads each worker claims at a time')
+        parser.add_argument('--report-interval', type=int, default=10, help='Seconds between queue depth and lag reports')
+        parser.add_argument('--once', action='store_true', help='Exit once the spool is empty rather than waiting for more')
+        parser.add_argument('--status', action='store_true', help='Report queue depth and lag then exit')
+        parser.add_argument('--retry-failed', action='store_true', help='Put failed payloads back in the queue before draining it')
+
+    def report(self, spool):
+        stats = spool.stats()
+        self.stdout.write("%i payloads waiting, %i failed holding back %i hosts, lag %.1fs, %i processed" % (stats['depth'], stats['failed'], stats['held'], stats['lag'], self.processed))
+
+    def work(self, spool, shard, shards, batch_size, once):
+        try:
+            while not self.stopping.is_set():
+                payloads = spool.pending(shard, shards, batch_size)
+                if not payloads:
+                    if once:
+                        return
+                    time.sleep(1)
+                    continue
+
+                stopped = set() # hosts with a payload that failed in this batch
+                for payload_id, host_id, received, body in payloads:
+                    if host_id in stopped:
+                        continue
+                    try:
+                        with transaction.atomic():
+                            host = Host.objects.get(pk=host_id)
+                            process_log(host, json.loads(body.decode('utf-8')))
+                    except Host.DoesNotExist: # host was removed after the payload was spooled
+                        pass
+                    except Exception as e:
+                        self.stderr.write("Could not process payload %i for host %i: %r" % (payload_id, host_id, e))
+                        spool.fail(payload_id)
+                        stopped.add(host_id)
+                        continue
+                    spool.done(payload_id)
+                    with self.lock:
+                        self.processed += 1
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        spool = get_spool()
+        if spool is None:
+            raise CommandError("OSQUERY_LOGGER_SPOOL is not set")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+
+        self.processed = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        if options['status']:
+            self.report(spool)
+            return
+
+        if options['retry_failed']:
+            self.stdout.write("Retrying %i failed payloads" % spool.retry())
+
+        workers = [threading.Thread(target=self.work, args=(spool, shard, options['workers'], options['batch_size'], options['once'])) for shard in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(options['report_interval'] / len(workers))
+                self.report(spool)
+        except KeyboardInterrupt:
+            self.stopping.set()
+            for worker in workers:
+                worker.join()
+            self.report(spool)
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from api.ingest import BATCH_SIZE
+from api.models import Host, Package
+from api.teardown import ROW_BATCH_SIZE, teardown_hosts
+
+import datetime
+import json
+
+class Command(BaseCommand):
+    help = 'Delete hosts that have not checked in for a number of days, along with their packages, log entries and problems'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Delete hosts not seen for this many days')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Hosts torn down together')
+        parser.add_argument('--row-batch-size', type=int, default=ROW_BATCH_SIZE, help='Packages, log entries or problems deleted in each transaction')
+        parser.add_argument('--archive', help='Append each host and its packages to this file, one JSON object per line, once it has been deleted')
+        parser.add_argument('--dry-run', action='store_true', help='Report the hosts that would be deleted without deleting them')
+
+    def archive(self, archive_file, host_ids):
+        """
+        Read what is to be archived for a batch of hosts before it is deleted, returning a callable that writes it out
+        once the delete has been committed.
+        """
+
+        packages = {}
+        for host_id, name, version, architecture in Package.objects.filter(host_id__in=host_ids).values_list('host_id', 'name', 'version', 'architecture').iterator():
+            packages.setdefault(host_id, []).append({'name': name, 'version': version, 'architecture': architecture})
+        lines = []
+        for host in Host.objects.filter(id__in=host_ids).values('id', 'node_key', 'identifier', 'last_seen', 'release', 'architecture', 'cpu', 'ram'):
+            host['packages'] = packages.get(host['id'], [])
+            lines.append(json.dumps(host, cls=DjangoJSONEncoder) + "\n")
+
+        def write():
+            archive_file.writelines(lines)
+            archive_file.flush()
+        return write
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError("--days must be at least 1")
+        if options['batch_size'] < 1 or options['row_batch_size'] < 1:
+            raise CommandError("--batch-size and --row-batch-size must be at least 1")
+
+        # last_seen lags behind by at most OSQUERY_HEARTBEAT_INTERVAL, which doesn't matter when counting in days
+        stale = Q(last_seen__lt=timezone.now() - datetime.timedelta(days=options['days']))
+        host_ids = list(Host.objects.filter(stale).values_list('id', flat=True))
+
+        if options['dry_run']:
+            for host in Host.objects.filter(id__in=host_ids).order_by('last_seen'):
+                self.stdout.write("%s last seen %s" % (host, host.last_seen))
+            self.stdout.write("Would delete %i hosts" % len(host_ids))
+            return
+
+        if options['archive']:
+            with open(options['archive'], 'a') as archive_file:
+                deleted = teardown_hosts(host_ids, options['batch_size'], stale, lambda batch: self.archive(archive_file, batch), options['row_batch_size'])
+        else:
+            deleted = teardown_hosts(host_ids, options['batch_size'], stale, row_batch_size=options['row_batch_size'])
+        self.stdout.write("Deleted %i hosts not seen for %i days" % (deleted, options['days']))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ingest import BATCH_SIZE
+from api.models import Host
+from api.teardown import ROW_BATCH_SIZE, teardown_hosts
+
+class Command(BaseCommand):
+    help = 'Delete hosts that have been marked to be re-enrolled, along with their packages, log entries and problems'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Hosts torn down together')
+        parser.add_argument('--row-batch-size', type=int, default=ROW_BATCH_SIZE, help='Packages, log entries or problems deleted in each transaction')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['row_batch_size'] < 1:
+            raise CommandError("--batch-size and --row-batch-size must be at least 1")
+
+        host_ids = list(Host.objects.filter(invalidate=True).values_list('id', flat=True))
+        deleted = teardown_hosts(host_ids, options['batch_size'], row_batch_size=options['row_batch_size'])
+        self.stdout.write("Deleted %i of %i invalidated hosts" % (deleted, len(host_ids)))
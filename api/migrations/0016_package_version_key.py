@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from api.versions import version_key
+
+
+def populate_version_keys(apps, schema_editor):
+    Package = apps.get_model('api', 'Package')
+    for version in Package.objects.values_list('version', flat=True).distinct().iterator():
+        Package.objects.filter(version=version).update(version_key=version_key(version))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_auto_20171120_2119'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='version_key',
+            field=models.CharField(help_text='Collation key for the version, so versions can be compared by the database.', max_length=255, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='package',
+            index_together=set([('name', 'architecture', 'version_key')]),
+        ),
+        migrations.RunPython(populate_version_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_releases(apps, schema_editor):
+    Host = apps.get_model('api', 'Host')
+    Package = apps.get_model('api', 'Package')
+    for release in Host.objects.values_list('release', flat=True).distinct().iterator():
+        Package.objects.filter(host__in=Host.objects.filter(release=release)).update(release=release)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_package_version_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='release',
+            field=models.CharField(blank=True, default='', editable=False, help_text="Operating system release of the host, copied here so matching doesn't need to join to it.", max_length=200),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_releases, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='package',
+            index_together=set([('name', 'architecture', 'release'), ('release', 'architecture')]),
+        ),
+    ]
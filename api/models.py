@@ -1,10 +1,17 @@
-from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.core.cache import cache
 from django.dispatch import receiver
 from django.utils import timezone
 
+from . import heartbeat
+from .signals import host_platform_changed
+from .nodekeys import node_keys
+from .versions import VERSION_KEY_LENGTH, version_key
+
 import math
 import datetime
+import time
 
 class Host(models.Model):
     """
@@ -28,10 +35,73 @@ class Host(models.Model):
     def ram_gib(self):
         return math.ceil(self.ram / 1024 / 1024 / 1024)
 
+    def seen(self):
+        """
+        Last time this host checked in, including check ins still waiting in the heartbeat buffer.
+        """
+
+        return heartbeat.last_seen(self.pk) or self.last_seen
+    seen.admin_order_field = 'last_seen'
+    seen.short_description = 'last seen'
+
     def alive(self):
-        return self.last_seen > timezone.now() - datetime.timedelta(minutes=30)
+        return self.seen() > timezone.now() - datetime.timedelta(minutes=30)
     alive.boolean = True
 
+@receiver(post_save, sender=Host)
+@receiver(post_delete, sender=Host)
+def evict_node_key(sender, **kwargs):
+    """
+    Drop a host from the node key cache whenever it changes, so a deleted or invalidated host can't authenticate.
+    """
+
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and not {'node_key', 'invalidate'} & set(update_fields): # e.g. the logger saving what it found out
+        return
+    node_keys.evict(kwargs.get('instance').node_key)
+
+PLATFORM_FIELDS = ('release', 'architecture')
+
+@receiver(post_init, sender=Host)
+def remember_platform(sender, **kwargs):
+    """
+    Note the release and architecture a host was loaded with, so changes to them can be spotted when it is saved.
+    """
+
+    instance = kwargs.get('instance')
+    instance._saved_platform = tuple(instance.__dict__.get(field) for field in PLATFORM_FIELDS) # None if not loaded
+
+@receiver(pre_save, sender=Host)
+def detect_platform_change(sender, **kwargs):
+    host = kwargs.get('instance')
+    update_fields = kwargs.get('update_fields')
+    host._platform_changed = False
+    if host.pk is None or kwargs.get('raw'):
+        return
+    if update_fields is not None and not set(PLATFORM_FIELDS) & set(update_fields):
+        return
+
+    saved_platform = host._saved_platform
+    if None in saved_platform: # not loaded with the host, e.g. when authenticated from the node key cache
+        saved_platform = Host.objects.filter(pk=host.pk).values_list(*PLATFORM_FIELDS).first() or saved_platform
+    host._previous_platform = saved_platform
+    host._platform_changed = None not in saved_platform and tuple(getattr(host, field) for field in PLATFORM_FIELDS) != saved_platform
+
+@receiver(post_save, sender=Host)
+def announce_platform_change(sender, **kwargs):
+    """
+    When a host has been saved with a new release or architecture let anything that depends on them know.
+    """
+
+    host = kwargs.get('instance')
+    if getattr(host, '_platform_changed', False):
+        if host.release != host._previous_platform[0]:
+            Package.objects.filter(host=host).update(release=host.release)
+        previous_release, previous_architecture = host._previous_platform
+        host_platform_changed.send(sender=Host, host=host, previous_release=previous_release, previous_architecture=previous_architecture)
+    host._saved_platform = tuple(host.__dict__.get(field) for field in PLATFORM_FIELDS)
+    host._platform_changed = False
+
 class Package(models.Model):
     """
     Operating system package
@@ -40,15 +110,23 @@ class Package(models.Model):
     name = models.CharField(db_index=True, max_length=200, help_text="Name of package from the operating system's package manager.")
     host = models.ForeignKey(Host, db_index=True)
     version = models.CharField(db_index=True, max_length=200, help_text="The package manager's version for this package.")
+    version_key = models.CharField(max_length=VERSION_KEY_LENGTH, null=True, help_text="Collation key for the version, so versions can be compared by the database.")
     architecture = models.CharField(max_length=200, help_text="Package architecture, which may differ from the host architecture.")
+    release = models.CharField(max_length=200, blank=True, editable=False, help_text="Operating system release of the host, copied here so matching doesn't need to join to it.")
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = (("name", "host", "architecture"),)
+        index_together = (("name", "architecture", "release"), ("release", "architecture"))
 
     def __unicode__(self):
         return "%s" % self.name
 
+    def save(self, *args, **kwargs):
+        self.version_key = version_key(self.version)
+        self.release = self.host.release
+        super().save(*args, **kwargs)
+
 class LogQuery(models.Model):
     """
     Query to be run on all hosts.
@@ -64,6 +142,51 @@ class LogQuery(models.Model):
     def __str__(self):
         return self.name
 
+CONFIG_VERSION_KEY = 'config_version'
+CONFIG_VERSION_CHECK_INTERVAL = 5 # seconds a process keeps using the config version before reading it again
+CONFIG_CACHE_TIMEOUT = 60 * 60 # seconds a rendered config is kept in the cache
+
+_config_version = (None, 0) # (version, when it was read) in this process
+
+def config_version():
+    """
+    Counter identifying the current set of log queries, bumped whenever one is saved or deleted.
+
+    It lives in the Django cache, which needs to be shared between processes for a change to reach all of them, and each
+    process only reads it every CONFIG_VERSION_CHECK_INTERVAL seconds, so a steady stream of config requests doesn't
+    touch the cache at all.
+    """
+
+    global _config_version
+    version, checked = _config_version
+    if version is not None and time.time() - checked < CONFIG_VERSION_CHECK_INTERVAL:
+        return version
+
+    version = cache.get(CONFIG_VERSION_KEY)
+    if version is None: # start from the clock so a lost counter can't come back to an old version
+        cache.add(CONFIG_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(CONFIG_VERSION_KEY)
+    _config_version = (version, time.time())
+    return version
+
+@receiver(post_save, sender=LogQuery)
+@receiver(post_delete, sender=LogQuery)
+def bump_config_version(sender, **kwargs):
+    """
+    When a log query changes make every node fetch a freshly rendered config, once the change is committed so the new
+    version can't be rendered from the old queries.
+    """
+
+    transaction.on_commit(_bump_config_version)
+
+def _bump_config_version():
+    global _config_version
+    _config_version = (None, 0) # this process sees the change straight away
+    try:
+        cache.incr(CONFIG_VERSION_KEY)
+    except ValueError: # counter not in the cache
+        config_version()
+
 class LogEntry(models.Model):
     """
     Logged query result.
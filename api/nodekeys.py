@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from collections import OrderedDict
+
+import logging
+import threading
+import time
+
+CHECK_INTERVAL = 5 # seconds between reads of the shared cache's generation
+REPORT_INTERVAL = 5 * 60 # seconds between log lines with the hit and miss counters
+
+logger = logging.getLogger(__name__)
+
+class NodeKeyCache(object):
+    """
+    Bounded LRU of node_key -> (host id, invalidate), so steady-state osquery traffic can be authenticated without the database.
+
+    Entries can also be kept in a shared Django cache. Every eviction then bumps a generation counter in the shared
+    cache, and local entries from an older generation are ignored. The counter is read at most every CHECK_INTERVAL
+    seconds, so local hits stay off the shared cache and a host evicted by one process is evicted for all of them within
+    a few seconds. Without a shared cache local entries only expire after ttl seconds, which bounds how stale another
+    process's view of a host can be.
+
+    The hit and miss counters are logged every REPORT_INTERVAL seconds while the cache is in use.
+    """
+
+    def __init__(self, size=10000, ttl=60, shared=None):
+        self.size = size
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation_value = None
+        self._generation_checked = 0
+        self._reported = time.time()
+
+    def _shared_key(self, node_key):
+        return 'node_key:%s' % node_key
+
+    def _generation(self):
+        """
+        Current generation of the shared cache, or None if there isn't one.
+        """
+
+        if self.shared is None:
+            return None
+        if time.time() - self._generation_checked >= CHECK_INTERVAL:
+            self._generation_value = caches[self.shared].get_or_set('node_key_generation', 0, None)
+            self._generation_checked = time.time()
+        return self._generation_value
+
+    def _store(self, node_key, value, generation):
+        with self._lock:
+            self._entries[node_key] = (value, time.time() + self.ttl, generation)
+            self._entries.move_to_end(node_key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get(self, node_key):
+        """
+        (host id, invalidate) for a node_key, or None if it has to be looked up.
+        """
+
+        generation = self._generation()
+        with self._lock:
+            entry = self._entries.get(node_key)
+            if entry is not None and entry[1] > time.time() and entry[2] == generation:
+                self._entries.move_to_end(node_key)
+                self.hits += 1
+                value = entry[0]
+            else:
+                value = None
+
+        if value is None and self.shared is not None:
+            value = caches[self.shared].get(self._shared_key(node_key))
+            if value is not None:
+                value = tuple(value)
+                self._store(node_key, value, generation)
+                with self._lock:
+                    self.shared_hits += 1
+
+        if value is None:
+            with self._lock:
+                self.misses += 1
+        self._report()
+        return value
+
+    def set(self, node_key, host_id, invalidate):
+        self._store(node_key, (host_id, invalidate), self._generation())
+        if self.shared is not None:
+            caches[self.shared].set(self._shared_key(node_key), (host_id, invalidate))
+
+    def evict(self, node_key):
+        with self._lock:
+            self._entries.pop(node_key, None)
+        if self.shared is not None:
+            caches[self.shared].delete(self._shared_key(node_key))
+            try:
+                caches[self.shared].incr('node_key_generation')
+            except ValueError: # counter not in the cache, so every process has to start again anyway
+                pass
+            self._generation_checked = 0 # this process's entries from before the eviction are stale straight away
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+    def _report(self):
+        if time.time() - self._reported < REPORT_INTERVAL:
+            return
+        self._reported = time.time()
+        logger.info("node key cache: %(hits)i hits, %(shared_hits)i shared hits, %(misses)i misses, %(entries)i entries, hit rate %(hit_rate).3f", self.stats())
+
+node_keys = NodeKeyCache(
+    size=getattr(settings, 'OSQUERY_NODE_KEY_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'OSQUERY_NODE_KEY_CACHE_TTL', 60),
+    shared=getattr(settings, 'OSQUERY_NODE_KEY_SHARED_CACHE', None),
+)
@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+# sent once per logger request with every package the request added to the host, after they have been written
+packages_added = Signal(providing_args=['host', 'packages'])
+
+# sent once per logger request with every (name, version, architecture) the request removed, before they are deleted
+packages_removed = Signal(providing_args=['host', 'packages'])
+
+# sent once per logger request with every (name, previous version, version, architecture) the request upgraded in place
+packages_upgraded = Signal(providing_args=['host', 'packages'])
+
+# sent after a host is saved with a different release or architecture to the one it had before
+host_platform_changed = Signal(providing_args=['host', 'previous_release', 'previous_architecture'])
+
+# sent for a batch of hosts being torn down, outside any transaction and before their packages, log entries and rows are
+# deleted; receivers delete what refers to the hosts at most batch_size rows per transaction
+hosts_removed = Signal(providing_args=['host_ids', 'batch_size'])
@@ -0,0 +1,91 @@
+from django.conf import settings
+
+import sqlite3
+import threading
+import time
+
+class Spool(object):
+    """
+    Durable queue of raw logger payloads, kept in a local SQLite database so the logger view can return straight away.
+
+    Payloads are drained by `manage.py drainspool`, which shards them by host so each host's payloads are applied in the
+    order they arrived.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL') # writers don't block the workers reading
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('CREATE TABLE IF NOT EXISTS payload (id INTEGER PRIMARY KEY AUTOINCREMENT, host_id INTEGER NOT NULL, received REAL NOT NULL, failed INTEGER NOT NULL DEFAULT 0, body BLOB NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS payload_pending ON payload (failed, id)')
+            connection.execute('CREATE INDEX IF NOT EXISTS payload_failed ON payload (failed, host_id)')
+            self._local.connection = connection
+        return connection
+
+    def append(self, host_id, body):
+        """
+        Durably record a payload for a host.
+        """
+
+        self._connection().execute('INSERT INTO payload (host_id, received, body) VALUES (?, ?, ?)', (host_id, time.time(), body))
+
+    def pending(self, shard=0, shards=1, limit=100):
+        """
+        Oldest payloads waiting to be processed for one shard of hosts, as (id, host_id, received, body).
+
+        Hosts with a failed payload are held back, as their later payloads only make sense once it has been applied.
+        """
+
+        return self._connection().execute('SELECT id, host_id, received, body FROM payload WHERE failed = 0 AND host_id % ? = ? AND host_id NOT IN (SELECT host_id FROM payload WHERE failed = 1) ORDER BY id LIMIT ?', (shards, shard, limit)).fetchall()
+
+    def done(self, payload_id):
+        self._connection().execute('DELETE FROM payload WHERE id = ?', (payload_id, ))
+
+    def fail(self, payload_id):
+        """
+        Set a payload aside, which stops its host's queue until it is retried so the host's changes stay in order.
+        """
+
+        self._connection().execute('UPDATE payload SET failed = 1 WHERE id = ?', (payload_id, ))
+
+    def retry(self):
+        """
+        Put every failed payload back in the queue, returning how many there were.
+        """
+
+        return self._connection().execute('UPDATE payload SET failed = 0 WHERE failed = 1').rowcount
+
+    def stats(self):
+        """
+        Queue depth, number of failed payloads, number of hosts held back by them and age in seconds of the oldest waiting payload.
+        """
+
+        depth, oldest = self._connection().execute('SELECT COUNT(*), MIN(received) FROM payload WHERE failed = 0').fetchone()
+        failed, held = self._connection().execute('SELECT COUNT(*), COUNT(DISTINCT host_id) FROM payload WHERE failed = 1').fetchone()
+        return {
+            'depth': depth,
+            'failed': failed,
+            'held': held,
+            'lag': time.time() - oldest if oldest is not None else 0.0,
+        }
+
+_spool = None
+
+def get_spool():
+    """
+    The spool configured by OSQUERY_LOGGER_SPOOL, or None if logger payloads should be processed inline.
+    """
+
+    global _spool
+    path = getattr(settings, 'OSQUERY_LOGGER_SPOOL', None)
+    if not path:
+        return None
+    if _spool is None or _spool.path != path:
+        _spool = Spool(path)
+    return _spool
@@ -0,0 +1,66 @@
+from django.db import transaction
+from django.db.models import Q
+
+from .ingest import BATCH_SIZE, chunks
+from .models import *
+from .nodekeys import node_keys
+from .signals import hosts_removed
+
+import functools
+
+ROW_BATCH_SIZE = 5000 # rows deleted in each transaction, however many hosts they belong to
+
+def _evict(node_key_list):
+    for node_key in node_key_list:
+        node_keys.evict(node_key)
+
+def delete_in_batches(queryset, batch_size=ROW_BATCH_SIZE):
+    """
+    Delete the rows matched by a queryset at most batch_size at a time, each batch in its own short transaction, with
+    set-based deletes that skip the ORM's cascade and signals. Only for rows nothing else refers to.
+    """
+
+    while True:
+        ids = list(queryset.order_by().values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        with transaction.atomic():
+            batch = queryset.model.objects.filter(id__in=ids)
+            batch._raw_delete(batch.db)
+
+def teardown_hosts(host_ids, batch_size=BATCH_SIZE, condition=Q(), archive=None, row_batch_size=ROW_BATCH_SIZE):
+    """
+    Delete hosts along with everything recorded about them, batch_size hosts at a time. Returns the number of hosts
+    deleted.
+
+    Each batch is first marked to be re-enrolled, so its hosts can't check in again while they are being torn down, and
+    hosts that no longer meet condition by then are left alone. Their packages and log entries are then deleted
+    row_batch_size at a time, in transactions of their own, so a host with a huge inventory doesn't hold locks for long,
+    and receivers of hosts_removed are expected to clear up anything else that refers to the hosts the same way. The
+    hosts themselves go last. Hosts left behind by a run that is interrupted stay marked, for teardownhosts to finish.
+
+    If archive is given it is called with the ids of each batch before anything is deleted, and returns a callable that
+    is run once the hosts' rows have been deleted and committed, so nothing is archived for hosts that survive.
+    """
+
+    deleted = 0
+    for batch in chunks(host_ids, batch_size):
+        with transaction.atomic():
+            hosts = Host.objects.filter(condition, id__in=batch).select_for_update()
+            batch = dict(hosts.values_list('id', 'node_key'))
+            if not batch:
+                continue
+            Host.objects.filter(id__in=batch, invalidate=False).update(invalidate=True) # no post_save, so evicted here
+            transaction.on_commit(functools.partial(_evict, list(batch.values())))
+        batch = list(batch)
+
+        write_archive = archive(batch) if archive is not None else None
+        hosts_removed.send(sender=Host, host_ids=batch, batch_size=row_batch_size)
+        for model in (Package, LogEntry):
+            delete_in_batches(model.objects.filter(host_id__in=batch), row_batch_size)
+
+        with transaction.atomic():
+            deleted += Host.objects.filter(id__in=batch).delete()[1].get(Host._meta.label, 0)
+            if write_archive is not None:
+                transaction.on_commit(write_archive)
+    return deleted
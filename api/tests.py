@@ -1,3 +1,385 @@
-from django.test import TestCase
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+from . import models, nodekeys
+from .jsonstream import JSONStream
+from .models import Host, Package
+from .versions import python_version_compare, version_key
+
+import gzip
+import io
+import json
+import random
+import re
+import time
+import zlib
+
+class SplitReader(object):
+    """
+    File-like object that returns a document in two reads, split at a given offset.
+    """
+
+    def __init__(self, data, split):
+        self.parts = [data[:split], data[split:]]
+
+    def read(self, size=-1):
+        while self.parts:
+            part = self.parts.pop(0)
+            if part:
+                return part
+        return b''
+
+class JSONStreamTests(SimpleTestCase):
+    documents = [
+        {"a": 1.5, "b": 2},
+        {"node_key": "abc", "data": [{"name": "x", "columns": {"version": "1:2.3-4ubuntu0.1"}}, -12, 3e10, -0.25e-3, 1E+2]},
+        {"strings": ["", "\"quoted\"", "back\\slash", "unicode é中", "{[not structure]}"], "nested": {"x": [[], {}, [1, [2, [3]]]]}},
+        {"literals": [True, False, None], "big": 123456789012345678901234567890, "n": -0},
+    ]
+
+    def walk(self, stream):
+        """
+        Read a document back one member at a time, skipping every other member of each object.
+        """
+
+        result = {}
+        for index, key in enumerate(stream.iter_object()):
+            if key == 'data' or key == 'strings':
+                result[key] = list(stream.iter_array())
+            elif index % 2:
+                stream.skip_value()
+            else:
+                result[key] = stream.read_value()
+        return result
+
+    def expected(self, document):
+        return {key: value for index, (key, value) in enumerate(document.items()) if key in ('data', 'strings') or not index % 2}
+
+    def test_split_at_every_offset(self):
+        for document in self.documents:
+            data = json.dumps(document, ensure_ascii=False).encode('utf-8')
+            for split in range(len(data) + 1):
+                self.assertEqual(self.walk(JSONStream(SplitReader(data, split))), self.expected(document), "split at %i of %r" % (split, data))
+
+    def test_every_chunk_size(self):
+        for document in self.documents:
+            data = json.dumps(document).encode('utf-8')
+            for chunk_size in range(1, len(data) + 2):
+                self.assertEqual(self.walk(JSONStream(io.BytesIO(data), chunk_size)), self.expected(document), "chunk size %i" % chunk_size)
+
+    def test_number_split_after_point(self):
+        stream = JSONStream(io.BytesIO(b'{"a": 1.5, "b": 2}'), 8)
+        self.assertEqual({key: stream.read_value() for key in stream.iter_object()}, {"a": 1.5, "b": 2})
+
+@override_settings(OSQUERY_ENROLL_SECRET='secret', OSQUERY_MAX_BODY_SIZE=1024)
+class RequestBodyTests(TestCase):
+    body = json.dumps({"enroll_secret": "secret", "host_identifier": "test"}).encode('utf-8')
+
+    def enroll(self, body, encoding=None):
+        headers = {'HTTP_CONTENT_ENCODING': encoding} if encoding else {}
+        return self.client.post('/enroll', body, content_type='application/json', **headers)
+
+    def assertEnrolled(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(json.loads(response.content.decode('utf-8'))['node_invalid'])
+
+    def test_identity(self):
+        self.assertEnrolled(self.enroll(self.body))
+
+    def test_gzip(self):
+        self.assertEnrolled(self.enroll(gzip.compress(self.body), 'gzip'))
+
+    def test_deflate(self):
+        self.assertEnrolled(self.enroll(zlib.compress(self.body), 'deflate'))
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.assertEnrolled(self.enroll(compressor.compress(self.body) + compressor.flush(), 'deflate'))
+
+    def test_unsupported_encoding(self):
+        self.assertEqual(self.enroll(self.body, 'br').status_code, 415)
+
+    def test_corrupt(self):
+        self.assertEqual(self.enroll(b'\x1f\x8b' + b'not really gzip' * 10, 'gzip').status_code, 400)
+        self.assertEqual(self.enroll(gzip.compress(self.body)[:10] + b'\xff' * 20, 'gzip').status_code, 400)
+
+    def test_truncated(self):
+        self.assertEqual(self.enroll(gzip.compress(self.body)[:-10], 'gzip').status_code, 400)
+
+    def test_too_large(self):
+        body = json.dumps({"enroll_secret": "secret", "padding": "x" * 2048}).encode('utf-8')
+        self.assertEqual(self.enroll(body).status_code, 413)
+        self.assertEqual(self.enroll(gzip.compress(body), 'gzip').status_code, 413)
+@override_settings(OSQUERY_STREAM_LOGGER=True, OSQUERY_LOGGER_SPOOL=None)
+class StreamedLoggerTests(TestCase):
+    def setUp(self):
+        self.host = Host.objects.create(node_key='0' * 32, identifier='test', ram=0, cpu='', release='jessie', architecture='x86_64')
+        self.entries = [{"name": "hotplatehosts_deb-packages", "action": "added", "hostIdentifier": "test", "columns": {"name": "bash", "version": "4.3-11", "arch": "amd64"}}]
+
+    def log(self, body):
+        return self.client.post('/logger', body, content_type='application/json')
+
+    def test_streamed(self):
+        response = self.log(json.dumps({"node_key": self.host.node_key, "log_type": "result", "data": self.entries}))
+        self.assertFalse(json.loads(response.content.decode('utf-8'))['node_invalid'])
+        self.assertTrue(Package.objects.filter(host=self.host, name='bash').exists())
+
+    def test_log_type_after_data(self):
+        body = '{"node_key": %s, "data": %s, "log_type": "result"}' % (json.dumps(self.host.node_key), json.dumps(self.entries))
+        response = self.log(body)
+        self.assertFalse(json.loads(response.content.decode('utf-8'))['node_invalid'])
+        self.assertTrue(Package.objects.filter(host=self.host, name='bash').exists())
+
+    def test_malformed_data(self):
+        body = '{"node_key": %s, "log_type": "result", "data": [%s, {"name": ]}' % (json.dumps(self.host.node_key), json.dumps(self.entries[0]))
+        self.assertEqual(self.log(body).status_code, 400)
+        self.assertFalse(Package.objects.filter(host=self.host).exists())
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'nodekeys': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'nodekeys'}})
+class NodeKeyCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.caches = [nodekeys.NodeKeyCache(shared='nodekeys') for _ in range(2)] # as if in two processes
+        self.caches[0].set('a' * 32, 1, False)
+
+    def test_local_hits_stay_off_shared_cache(self):
+        self.assertEqual(self.caches[0].get('a' * 32), (1, False))
+        shared = nodekeys.caches['nodekeys']
+        get_or_set = shared.get_or_set
+        try:
+            shared.get_or_set = None # any read of the generation would fail
+            for _ in range(100):
+                self.assertEqual(self.caches[0].get('a' * 32), (1, False))
+        finally:
+            shared.get_or_set = get_or_set
+        self.assertEqual(self.caches[0].stats()['hits'], 101)
+
+    def test_eviction_reaches_other_processes(self):
+        self.assertEqual(self.caches[1].get('a' * 32), (1, False))
+        self.caches[0].evict('a' * 32)
+        self.assertIsNone(self.caches[0].get('a' * 32))
+        self.caches[1]._generation_checked -= nodekeys.CHECK_INTERVAL # as if the interval had passed
+        self.assertIsNone(self.caches[1].get('a' * 32))
+
+    def test_stats_logged(self):
+        self.caches[0]._reported = time.time() - nodekeys.REPORT_INTERVAL
+        with self.assertLogs('api.nodekeys', 'INFO') as logs:
+            self.caches[0].get('b' * 32)
+        self.assertIn("1 misses", logs.output[0])
+
+class ConfigVersionTests(SimpleTestCase):
+    def setUp(self):
+        models._config_version = (None, 0)
+        models.cache.clear()
+
+    def test_read_once_per_interval(self):
+        version = models.config_version()
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}): # reads would find nothing
+            self.assertEqual(models.config_version(), version)
+
+    def test_bump_seen_straight_away(self):
+        version = models.config_version()
+        models._bump_config_version()
+        self.assertEqual(models.config_version(), version + 1)
+
+def _dpkg_order(character):
+    if character.isdigit():
+        return 0
+    if character.isalpha():
+        return ord(character)
+    if character == '~':
+        return -1
+    return ord(character) + 256
+
+def _verrevcmp(string, other):
+    """
+    Straight port of dpkg's verrevcmp(), as a reference to check the version code against.
+    """
+
+    i = j = 0
+    while i < len(string) or j < len(other):
+        first_difference = 0
+        while (i < len(string) and not string[i].isdigit()) or (j < len(other) and not other[j].isdigit()):
+            string_order = _dpkg_order(string[i]) if i < len(string) else 0
+            other_order = _dpkg_order(other[j]) if j < len(other) else 0
+            if string_order != other_order:
+                return string_order - other_order
+            i += 1
+            j += 1
+        while i < len(string) and string[i] == '0':
+            i += 1
+        while j < len(other) and other[j] == '0':
+            j += 1
+        while i < len(string) and string[i].isdigit() and j < len(other) and other[j].isdigit():
+            if not first_difference:
+                first_difference = ord(string[i]) - ord(other[j])
+            i += 1
+            j += 1
+        if i < len(string) and string[i].isdigit():
+            return 1
+        if j < len(other) and other[j].isdigit():
+            return -1
+        if first_difference:
+            return first_difference
+    return 0
+
+def reference_version_compare(version, other):
+    """
+    dpkg's comparison of two versions, using python-apt when it is installed.
+    """
+
+    try:
+        import apt_pkg
+        apt_pkg.init_system()
+        return apt_pkg.version_compare(version, other)
+    except ImportError:
+        pass
+
+    def split(version):
+        epoch, colon, rest = version.partition(':')
+        if not colon:
+            epoch, rest = '0', version
+        upstream, hyphen, revision = rest.rpartition('-')
+        if not hyphen:
+            upstream, revision = rest, ''
+        return int(epoch), upstream, revision
+
+    epoch, upstream, revision = split(version)
+    other_epoch, other_upstream, other_revision = split(other)
+    return (epoch - other_epoch) or _verrevcmp(upstream, other_upstream) or _verrevcmp(revision, other_revision)
+
+def sign(number):
+    return (number > 0) - (number < 0)
+
+def random_version(rng):
+    """
+    A random but valid Debian version, leaning towards the characters where ordering gets interesting.
+    """
+
+    def part(length):
+        return ''.join(rng.choice('0000112999abzAZ.+~~') for _ in range(length))
+
+    version = rng.choice('0123456789') + part(rng.randint(0, 8))
+    if rng.random() < 0.5:
+        version += '-' + part(rng.randint(0, 6))
+    if rng.random() < 0.2:
+        version = '%i:%s' % (rng.randint(0, 3), version)
+    return version
+
+class VersionKeyTests(SimpleTestCase):
+    versions = ['0', '00', '0a', '1', '1.0', '1.0~rc1', '1.0~~', '1.0+b1', '1.0-1', '1.0-1~bpo1', '1:0.9', '1.00', '1.0a', '1.0A', '2.30-1ubuntu0.1', '2.3', '10', '9.9', '1.0-0', '1.0-']
+
+    def assertOrdered(self, version, other):
+        key, other_key = version_key(version), version_key(other)
+        if key is None or other_key is None: # compared in Python instead, see version_is_older
+            return
+        self.assertEqual(sign((key > other_key) - (key < other_key)), sign(reference_version_compare(version, other)), "%r vs %r" % (version, other))
+
+    def test_known_versions(self):
+        for version in self.versions:
+            for other in self.versions:
+                self.assertOrdered(version, other)
+
+    def test_random_versions(self):
+        rng = random.Random(1)
+        for _ in range(20000):
+            self.assertOrdered(random_version(rng), random_version(rng))
+
+    def test_invalid_versions_have_no_key(self):
+        for version in ('', 'a b', '1.0_1', '1.0/1'):
+            self.assertIsNone(version_key(version))
+
+class PythonVersionCompareTests(SimpleTestCase):
+    def assertSameOrder(self, version, other):
+        expected = sign(reference_version_compare(version, other))
+        self.assertEqual(sign(python_version_compare(version, other)), expected, "%r vs %r" % (version, other))
+
+        key, other_key = version_key(version), version_key(other)
+        if key is not None and other_key is not None: # the keys and the comparator have to agree for matching to
+            self.assertEqual(sign((key > other_key) - (key < other_key)), sign(python_version_compare(version, other)), "%r vs %r" % (version, other))
+
+    def test_known_versions(self):
+        for version in VersionKeyTests.versions:
+            for other in VersionKeyTests.versions:
+                self.assertSameOrder(version, other)
+
+    def test_random_versions(self):
+        rng = random.Random(2)
+        for _ in range(20000):
+            self.assertSameOrder(random_version(rng), random_version(rng))
+
+def index_named(model, columns):
+    """
+    Name of the index on a model's table over exactly the given columns, in order.
+    """
+
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    for name, constraint in constraints.items():
+        if constraint['index'] and constraint['columns'] == list(columns):
+            return name
+    raise AssertionError("%s has no index on %s" % (model._meta.db_table, ", ".join(columns)))
+
+def planned_indexes(queryset):
+    """
+    Names of the indexes the database plans to read a queryset through, from EXPLAIN.
+    """
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return set(re.findall(r'USING (?:COVERING )?INDEX (\w+)', " ".join(row[-1] for row in cursor.fetchall())))
+        cursor.execute('EXPLAIN ' + sql, params)
+        key = [column[0] for column in cursor.description].index('key')
+        return {name for row in cursor.fetchall() if row[key] for name in row[key].split(',')}
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        if connection.vendor not in ('mysql', 'sqlite'):
+            self.skipTest("EXPLAIN output isn't understood for %s" % connection.vendor)
+
+    def assertUsesIndex(self, queryset, model, *indexes):
+        """
+        Check that the database reads a queryset through one of the indexes over the given lists of columns.
+        """
+
+        names = {index_named(model, columns) for columns in indexes}
+        planned = planned_indexes(queryset)
+        self.assertTrue(names & planned, "%s uses %s rather than %s" % (queryset.query, ", ".join(planned) or "no index", ", ".join(names)))
+
+class PackageQueryTests(QueryPlanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hosts = [Host.objects.create(node_key=str(index) * 32, identifier='host%i' % index, ram=0, cpu='', release=release, architecture='x86_64') for index, release in enumerate(['jessie', 'jessie', 'stretch'])]
+        for host in self.hosts:
+            for index in range(30):
+                Package.objects.create(host=host, name='package%i' % index, version='1.%i-1' % index, architecture='amd64')
+
+    def test_release_copied_from_host(self):
+        self.assertEqual(Package.objects.filter(release='jessie').count(), 60)
+        self.hosts[0].release = 'stretch'
+        self.hosts[0].save()
+        self.assertEqual(set(Package.objects.filter(host=self.hosts[0]).values_list('release', flat=True)), {'stretch'})
+
+    def test_advisory_package_query(self):
+        """
+        The query match_advisory_packages makes for each advisory package.
+        """
+
+        packages = Package.objects.filter(Q(name='package3', architecture='amd64', release='jessie') & (Q(version_key__lt=version_key('1.3-2')) | Q(version_key__isnull=True)))
+        self.assertNotIn(Host._meta.db_table, str(packages.query))
+        self.assertUsesIndex(packages, Package, ('name', 'architecture', 'release'))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(packages.values_list('name', 'version', 'version_key', 'architecture', 'release').distinct()), 1)
+
+    def test_rematch_query(self):
+        """
+        The query expected_problems makes for each batch of advisory package names.
+        """
+
+        packages = Package.objects.filter(architecture='amd64', release='jessie', name__in=['package1', 'package2']).values_list('name', 'version', 'version_key').annotate(installs=Count('id')).order_by()
+        self.assertNotIn(Host._meta.db_table, str(packages.query))
+        self.assertUsesIndex(packages, Package, ('name', 'architecture', 'release'), ('release', 'architecture'))
+        with self.assertNumQueries(1):
+            self.assertEqual({installs for name, version, key, installs in packages}, {2})
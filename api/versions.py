@@ -0,0 +1,154 @@
+from django.conf import settings
+
+import functools
+import re
+
+VERSION_KEY_LENGTH = 255
+
+_parts = re.compile(r'([^0-9]*)([0-9]*)')
+_version = re.compile(r'^(?:([0-9]+):)?([A-Za-z0-9.+~:-]+)$')
+
+def _order(character):
+    """
+    Byte standing for a character in the non-digit part of a version: '~' before the end of the part, the end of the
+    part before letters, and letters before everything else.
+    """
+
+    if character == '~':
+        return 1
+    if character.isalpha():
+        return ord(character)
+    return ord(character) + 128
+
+def _number_key(digits):
+    digits = digits.lstrip('0')
+    return bytes([len(digits) + 1]) + digits.encode('ascii')
+
+def _string_key(string):
+    if string == '': # nothing at all compares the same as "0"
+        string = '0'
+
+    key = bytearray()
+    position = 0
+    while position < len(string):
+        match = _parts.match(string, position)
+        key += bytes(_order(character) for character in match.group(1))
+        key.append(2)
+        key += _number_key(match.group(2))
+        position = match.end()
+    key.append(2)
+    return bytes(key)
+
+def version_key(version):
+    """
+    Collation key for a Debian version, such that comparing two keys as strings orders them the same way dpkg orders the
+    versions, which lets the database answer "older than" questions itself.
+
+    Returns None for versions that aren't valid or whose key would not fit in VERSION_KEY_LENGTH characters, which have
+    to be compared in Python instead.
+    """
+
+    match = _version.match(version or '')
+    if match is None:
+        return None
+
+    epoch, rest = match.group(1) or '0', match.group(2)
+    upstream, hyphen, revision = rest.rpartition('-')
+    if not hyphen:
+        upstream, revision = rest, ''
+
+    try:
+        key = (_number_key(epoch) + _string_key(upstream) + _string_key(revision)).hex()
+    except ValueError: # a number too long to fit its length in a byte
+        return None
+    if len(key) > VERSION_KEY_LENGTH:
+        return None
+    return key
+
+def _character_order(character):
+    if character.isdigit():
+        return 0
+    if character.isalpha():
+        return ord(character)
+    if character == '~':
+        return -1
+    return ord(character) + 256
+
+def _compare_strings(string, other):
+    """
+    dpkg's comparison of one upstream version or revision with another.
+    """
+
+    i = j = 0
+    while i < len(string) or j < len(other):
+        while (i < len(string) and not string[i].isdigit()) or (j < len(other) and not other[j].isdigit()):
+            difference = (_character_order(string[i]) if i < len(string) else 0) - (_character_order(other[j]) if j < len(other) else 0)
+            if difference:
+                return difference
+            i += 1
+            j += 1
+
+        number_start, other_start = i, j
+        while i < len(string) and string[i].isdigit():
+            i += 1
+        while j < len(other) and other[j].isdigit():
+            j += 1
+        difference = int(string[number_start:i] or 0) - int(other[other_start:j] or 0)
+        if difference:
+            return difference
+    return 0
+
+def _split(version):
+    epoch, colon, rest = version.partition(':')
+    if not colon or not epoch.isdigit():
+        epoch, rest = '0', version
+    upstream, hyphen, revision = rest.rpartition('-')
+    if not hyphen:
+        upstream, revision = rest, ''
+    return int(epoch), upstream, revision
+
+def python_version_compare(version, other):
+    """
+    Pure Python equivalent of apt_pkg.version_compare, for processes that don't want to load python-apt.
+    """
+
+    epoch, upstream, revision = _split(version)
+    other_epoch, other_upstream, other_revision = _split(other)
+    return (epoch - other_epoch) or _compare_strings(upstream, other_upstream) or _compare_strings(revision, other_revision)
+
+_comparator = None
+
+def _load_comparator():
+    global _comparator
+    if _comparator is None:
+        if getattr(settings, 'VERSION_COMPARE_USE_APT', True):
+            try:
+                import apt_pkg
+                apt_pkg.init_system()
+                _comparator = apt_pkg.version_compare
+            except ImportError:
+                _comparator = python_version_compare
+        else:
+            _comparator = python_version_compare
+    return _comparator
+
+@functools.lru_cache(maxsize=getattr(settings, 'VERSION_COMPARE_CACHE_SIZE', 65536))
+def version_compare(version, other):
+    """
+    Compare two Debian versions the way apt_pkg.version_compare does, remembering recent answers as the same pairs come
+    up over and over across hosts and advisories.
+
+    apt_pkg is only loaded on first use, and not at all if VERSION_COMPARE_USE_APT is off.
+    """
+
+    return _load_comparator()(version, other)
+
+def version_compare_stats():
+    info = version_compare.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'entries': info.currsize,
+        'hit_rate': info.hits / lookups if lookups else 0.0,
+    }
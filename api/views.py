@@ -1,26 +1,151 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.core.exceptions import PermissionDenied, SuspiciousOperation, ObjectDoesNotExist
 from django.views.decorators.http import require_http_methods
 from django.utils.timezone import now
-from django.db import transaction
-from django.db.utils import IntegrityError
+from django.db import DatabaseError, router, transaction
 from django.utils.text import slugify
 
 from .models import *
+from . import heartbeat
+from .nodekeys import node_keys
+from .ingest import process_log
+from .jsonstream import JSONStream
+from .spool import get_spool
 
 import json
 import random
 import string
 import functools
+import zlib
+
+class BodyError(Exception):
+    """
+    Request body that can't be read, answered with an HTTP error rather than node_invalid so the node keeps its node key.
+    """
+
+    status = 400
+
+class BodyTooLarge(BodyError):
+    status = 413
+
+class UnsupportedEncoding(BodyError):
+    status = 415
+
+class BodyReader(object):
+    """
+    File-like view of a request body, decompressed according to its Content-Encoding.
+
+    At most OSQUERY_MAX_BODY_SIZE bytes are returned after decompression, so a small compressed body can't expand without limit.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        self.limit = settings.OSQUERY_MAX_BODY_SIZE
+        self.returned = 0
+        self.started = False
+        if self.encoding in ('', 'identity'):
+            self.decompressor = None
+        elif self.encoding in ('gzip', 'x-gzip', 'deflate'):
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS) # accepts both gzip and zlib headers
+        else:
+            raise UnsupportedEncoding("unsupported Content-Encoding %r" % self.encoding)
+
+    def _decompress(self, compressed, size):
+        try:
+            return self.decompressor.decompress(compressed, size)
+        except zlib.error:
+            if self.started or self.encoding != 'deflate':
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS) # some clients send deflate without the zlib header
+            return self.decompressor.decompress(compressed, size)
+        finally:
+            self.started = True
+
+    def read(self, size=64 * 1024):
+        if self.decompressor is None:
+            data = self.request.read(size)
+        else:
+            data = b''
+            try:
+                while not data:
+                    compressed = self.decompressor.unconsumed_tail or self.request.read(size)
+                    if not compressed:
+                        data = self.decompressor.flush()
+                        if not self.decompressor.eof: # the body stopped part way through the stream
+                            raise BodyError("compressed request body is truncated")
+                        break
+                    data = self._decompress(compressed, size)
+            except zlib.error as e:
+                raise BodyError("compressed request body is corrupt: %s" % e)
+
+        self.returned += len(data)
+        if self.returned > self.limit:
+            raise BodyTooLarge("request body is too large")
+        return data
+
+def request_body(request):
+    """
+    The whole body of a request, decompressed.
+    """
+
+    if not hasattr(request, '_decoded_body'):
+        reader = BodyReader(request)
+        request._decoded_body = b''.join(iter(reader.read, b''))
+    return request._decoded_body
 
 def decode_json_body(fn):
     @functools.wraps(fn)
     def wrap(request, *args, **kwargs):
         try:
-            form = json.loads(request.body.decode('utf-8'))
+            form = json.loads(request_body(request).decode('utf-8'))
+        except BodyError as e:
+            return HttpResponse(str(e), status=e.status)
+        except:
+            response = {
+                "node_invalid": True
+            }
+            return JsonResponse(response)
+        return fn(request, form, *args, **kwargs)
+    return wrap
+
+def _checked_entries(stream):
+    """
+    Entries of a streamed "data" array, with a body found to be malformed part way through answered like any other.
+    """
+
+    try:
+        yield from stream.iter_array()
+    except ValueError as e:
+        raise BodyError("request body is not valid JSON: %s" % e)
+
+def stream_json_body(fn):
+    """
+    Like decode_json_body, but when OSQUERY_STREAM_LOGGER is set the "data" array is handed to the view as an iterator
+    that parses entries as they are read from the request, so a large payload is never held in memory all at once. That
+    needs "node_key" and "log_type" to come before "data", as osquery sends them, otherwise the body is read in full.
+    """
+
+    @functools.wraps(fn)
+    def wrap(request, *args, **kwargs):
+        if not settings.OSQUERY_STREAM_LOGGER or get_spool() is not None: # the spool keeps the whole body anyway
+            return decode_json_body(fn)(request, *args, **kwargs)
+
+        try:
+            stream = JSONStream(BodyReader(request))
+            form = {}
+            for key in stream.iter_object():
+                if key == 'data' and 'node_key' in form and 'log_type' in form: # osquery sends data last, anything after it is left unread
+                    form['data'] = _checked_entries(stream)
+                    break
+                form[key] = stream.read_value()
+        except BodyError as e:
+            return HttpResponse(str(e), status=e.status)
         except:
             response = {
                 "node_invalid": True
@@ -33,12 +158,16 @@ def retrieve_host(fn):
     @functools.wraps(fn)
     def wrap(request, form, *args, **kwargs):
         try:
-            host = Host.objects.get(node_key=form['node_key'])
-            if host.invalidate:
-                host.delete()
+            cached = node_keys.get(form['node_key'])
+            if cached is None:
+                host = Host.objects.get(node_key=form['node_key'])
+                node_keys.set(host.node_key, host.pk, host.invalidate)
+            else: # the rest of the host is only loaded from the database if the view uses it
+                host_id, invalidate = cached
+                host = Host.from_db(router.db_for_read(Host), ['id', 'node_key', 'invalidate'], [host_id, form['node_key'], invalidate])
+            if host.invalidate: # left for `manage.py teardownhosts` to delete, the node just has to enroll again
                 raise ObjectDoesNotExist
-            host.last_seen = now()
-            host.save()
+            heartbeat.beat(host, now())
         except ObjectDoesNotExist:
             response = {
                 "node_invalid": True
@@ -66,11 +195,11 @@ def enroll(request, form):
 
     return JsonResponse(response)
 
-@decode_json_body
-@retrieve_host
-@csrf_exempt
-@require_http_methods(['POST'])
-def config(request, form, host):
+def render_config():
+    """
+    The schedule every node is sent, as JSON.
+    """
+
     response = {
         "schedule": {
             "hotplatehosts_os-version": {
@@ -100,55 +229,52 @@ def config(request, form, host):
            "interval": query.interval
         }
 
-    return JsonResponse(response)
+    return json.dumps(response, cls=DjangoJSONEncoder).encode('utf-8')
+
+_rendered_config = (None, None) # (config version, rendered body) last served by this process
 
-@transaction.atomic
 @decode_json_body
 @retrieve_host
 @csrf_exempt
 @require_http_methods(['POST'])
+def config(request, form, host):
+    global _rendered_config
+    version = config_version()
+    if _rendered_config[0] != version:
+        cache_key = 'config:%s' % version
+        body = cache.get(cache_key)
+        if body is None:
+            body = render_config()
+            cache.set(cache_key, body, CONFIG_CACHE_TIMEOUT)
+        _rendered_config = (version, body)
+
+    return HttpResponse(_rendered_config[1], content_type='application/json')
+
+@transaction.atomic
+@stream_json_body
+@retrieve_host
+@csrf_exempt
+@require_http_methods(['POST'])
 def logger(request, form, host):
-    if form['log_type'] == 'result': # a "change" on a query
-        host.identifier = form['data'][0]['hostIdentifier']
-        for submitted_log_entry in form['data']:
-            entry_name = submitted_log_entry['name']
-            entry_action = submitted_log_entry['action']
-           
-            recognised_action = False
-            if entry_action == 'added':
-                entry_output = submitted_log_entry['columns']
-                if entry_name == "hotplatehosts_os-version":
-                    host.release = entry_output['version'].split()[-1].strip('()')
-                    recognised_action = True
-                elif entry_name == "hotplatehosts_osrelease":
-                    host.architecture = entry_output['current_value'].split('-')[-1]
-                    recognised_action = True
-                elif entry_name == "hotplatehosts_deb-packages":
-                    with transaction.atomic():
-                        try:
-                            Package.objects.create(name=entry_output['name'], host=host, version=entry_output['version'], architecture=entry_output['arch'])
-                        except IntegrityError: # ignore duplicates
-                            continue
-                    recognised_action = True
-            
-            elif entry_action == 'removed':
-                entry_output = submitted_log_entry['columns']
-                if entry_name == "hotplatehosts_deb-packages":
-                    recognised_action = True
-                    Package.objects.filter(name=entry_output['name'], host=host, version=entry_output['version'], architecture=entry_output['arch']).delete()
-            
-            elif entry_action == 'snapshot': # full snapshot query
-                entry_outputs = submitted_log_entry['snapshot']
-                for entry_output in entry_outputs:
-                    if entry_name == "hotplatehosts_system-info":
-                        host.cpu = entry_output['cpu_brand']
-                        host.ram = int(entry_output['physical_memory'])
-            
-            if recognised_action == False and entry_action in ('added', 'removed') and entry_name.startswith('hotplatehosts_db_'): # just log in to the db
-                    log_entry = LogEntry(name=entry_name[17:], action=entry_action, output=repr(entry_output), host=host)
-                    log_entry.save()
-
-    host.save()
+    spool = get_spool()
+    if spool is not None: # leave the work to `manage.py drainspool`
+        spool.append(host.id, request_body(request))
+    else:
+        try:
+            with transaction.atomic():
+                process_log(host, form)
+        except BodyError as e: # only found out while streaming the entries, which are rolled back
+            return HttpResponse(str(e), status=e.status)
+        except DatabaseError:
+            if Host.objects.filter(pk=host.pk).exists():
+                raise
+            # deleted since it was authenticated from another process's node key cache
+            node_keys.evict(form['node_key'])
+            response = {
+                "node_invalid": True
+            }
+            return JsonResponse(response)
+
     response = {
         "node_invalid": False
     }
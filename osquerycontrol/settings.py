@@ -75,6 +75,41 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# The log query config version lives in here, so when more than one process serves osquery this has to be a cache they
+# all share for a change to reach every node. Use memcached for that, for instance:
+#
+#     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#     'LOCATION': '127.0.0.1:11211',
+#
+# DatabaseCache works too, after `manage.py createcachetable`, at the cost of a query every few seconds per process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Logging
+# https://docs.djangoproject.com/en/1.11/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -118,6 +153,8 @@ DATA_UPLOAD_MAX_NUMBER_FIELDS = 65535
 
 FIX_REASONS = (
     ('removed', 'Package removed'),
+    ('rematched', 'No longer applicable'),
+    ('upgraded', 'Package upgraded'),
 )
 
 # Imported from patch-friend...
@@ -168,3 +205,38 @@ SOURCE_PACKAGE_DETAIL_URLS = {
 
 APTGET_COMMAND_STUB = 'sudo apt --only-upgrade install'
 
+
+# Path to a SQLite file in which to spool logger payloads for `manage.py drainspool`, or None to process them inline
+OSQUERY_LOGGER_SPOOL = None
+
+# How often, in seconds, buffered host check ins are written to the database
+OSQUERY_HEARTBEAT_INTERVAL = 30
+
+# Node key authentication cache: entries kept per process, seconds before a process re-checks a host, and optionally
+# the name of a shared cache in CACHES so evictions reach every process within a few seconds. Without one, a host deleted
+# or invalidated in one process can still authenticate in the others for up to OSQUERY_NODE_KEY_CACHE_TTL seconds. Each
+# process logs its hits and misses every five minutes to the api.nodekeys logger
+OSQUERY_NODE_KEY_CACHE_SIZE = 10000
+OSQUERY_NODE_KEY_CACHE_TTL = 60
+OSQUERY_NODE_KEY_SHARED_CACHE = None
+
+# Largest request body, after decompression, accepted from osquery nodes
+OSQUERY_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Parse logger payloads incrementally, applying package changes in chunks as they are read from the request
+OSQUERY_STREAM_LOGGER = False
+
+# Target false positive rate when sizing the filter of packages that have appeared in advisories
+ADVISORY_FILTER_FALSE_POSITIVE_RATE = 0.01
+
+# Compare Debian versions with python-apt rather than the pure Python comparator, and how many answers to remember
+VERSION_COMPARE_USE_APT = True
+VERSION_COMPARE_CACHE_SIZE = 65536
+
+# Advisory feed downloads: requests in flight at once, at most how many of them to the same host, and retries of each
+ADVISORY_FETCH_WORKERS = 8
+ADVISORY_FETCH_PER_HOST = 4
+ADVISORY_FETCH_RETRIES = 5
+
+# How long, in seconds, a package version missing from snapshot.debian.org is assumed to still be missing
+ADVISORY_SNAPSHOT_MISSING_TTL = 3 * 24 * 60 * 60